@@ -0,0 +1,615 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageChops, ImageDraw, ImageOps
+
+try:
+    import numpy
+except ImportError:  # 只有 bench_numpy_mirror 需要 NumPy
+    numpy = None
+
+import image_process
+from image_process import (crop_size, crop_mirror_image, quadrant_mirror_image, process_animated_image,
+                           iter_animated_image, iter_frames, encode_gif_stream, process_static_image, load_image_scaled,
+                           ORIENTATION_TAG, PALETTE_SAMPLE_FRAMES)
+
+
+def make_frames(frame_count: int, size: tuple) -> list:
+    """
+    生成用于测试的合成 RGBA 帧序列
+    """
+    width, height = size
+    # 渐变背景让量化有真实的颜色压力
+    gradient = Image.merge('RGB', (
+        Image.linear_gradient('L').resize(size),
+        Image.linear_gradient('L').rotate(90).resize(size),
+        Image.radial_gradient('L').resize(size),
+    ))
+    frames = []
+    for index in range(frame_count):
+        frame = Image.new('RGBA', size, (0, 0, 0, 0))
+        frame.paste(gradient.crop((0, 0, width, height // 2)), (0, height // 2))
+        draw = ImageDraw.Draw(frame)
+        offset = index * 7 % width
+        draw.ellipse((offset, 0, offset + width // 3, height // 3), fill=(255, index * 13 % 256, 0, 255))
+        draw.rectangle((0, height // 2, width // 2, height), fill=(0, 120, 220, 200))
+        frames.append(frame)
+    return frames
+
+
+def make_gif(frame_count: int, size: tuple, transparent: bool = True, disposal: int = 2) -> bytes:
+    frames = make_frames(frame_count, size)
+    if not transparent:
+        frames = [frame.convert('RGB') for frame in frames]
+    buffer = io.BytesIO()
+    frames[0].save(buffer, format='GIF', save_all=True, append_images=frames[1:], duration=50, loop=0,
+                   disposal=disposal)
+    return buffer.getvalue()
+
+
+def make_static(megapixels: float, image_format: str) -> bytes:
+    """
+    生成约 megapixels 百万像素、4:3 的静态图像
+    """
+    width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    frame = make_frames(1, (width, height))[0]
+    if image_format == 'JPEG':
+        frame = frame.convert('RGB')
+    buffer = io.BytesIO()
+    frame.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def legacy_quadrant(frame: Image.Image, crop_width: int, crop_height: int, width: int, height: int, side: str):
+    # 旧实现：先左右镜像生成中间画布，再上下镜像
+    first, second = {"q1": ("left", "up"), "q2": ("right", "up"),
+                     "q3": ("right", "down"), "q4": ("left", "down")}[side]
+    new_canvas = Image.new('RGBA', (crop_width * 2, height), (0, 0, 0, 0))
+    new_frame = crop_mirror_image(frame, new_canvas, crop_width, crop_height, width, height, first)
+    new_canvas = Image.new('RGBA', (crop_width * 2, crop_height * 2), (0, 0, 0, 0))
+    return crop_mirror_image(new_frame, new_canvas, crop_width, crop_height, crop_width * 2, height, second)
+
+
+def single_pass_quadrant(frame: Image.Image, crop_width: int, crop_height: int, width: int, height: int, side: str):
+    new_canvas = Image.new('RGBA', (crop_width * 2, crop_height * 2), (0, 0, 0, 0))
+    return quadrant_mirror_image(frame, new_canvas, crop_width, crop_height, width, height, side)
+
+
+def bench_quadrant(frame_count: int = 100, size: tuple = (800, 600), side: str = "q1", repeat: int = 3):
+    frames = make_frames(frame_count, size)
+    width, height = size
+    crop_width, crop_height = width // 2, height // 2
+
+    results = {}
+    for name, func in [("legacy", legacy_quadrant), ("single_pass", single_pass_quadrant)]:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                for frame in frames:
+                    func(frame, crop_width, crop_height, width, height, side)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = best
+
+    for name, elapsed in results.items():
+        print(f"{name:12s} {elapsed * 1000 / frame_count:8.3f} ms/frame")
+    print(f"speedup: {results['legacy'] / results['single_pass']:.2f}x "
+          f"({frame_count} frames, {width}x{height}, {side})")
+    return results
+
+
+def numpy_mirror(pixels, crop_width: int, crop_height: int, width: int, height: int, side: str):
+    """
+    NumPy 切片版的裁切镜像，只用于 bench_numpy_mirror 的对比。
+    pixels 的最后三维为 (高, 宽, 通道)，前面可以有帧维度，整叠帧一次处理
+    """
+    if side in ("left", "right"):
+        cropped = pixels[..., :, :crop_width, :] if side == "left" else pixels[..., :, width - crop_width:, :]
+        tiles = (cropped, cropped[..., :, ::-1, :]) if side == "left" else (cropped[..., :, ::-1, :], cropped)
+        return numpy.concatenate(tiles, axis=-2)
+    if side in ("up", "down"):
+        cropped = pixels[..., :crop_height, :, :] if side == "up" else pixels[..., height - crop_height:, :, :]
+        tiles = (cropped, cropped[..., ::-1, :, :]) if side == "up" else (cropped[..., ::-1, :, :], cropped)
+        return numpy.concatenate(tiles, axis=-3)
+    top = slice(None, crop_height) if side in ("q1", "q2") else slice(height - crop_height, None)
+    left = slice(None, crop_width) if side in ("q1", "q4") else slice(width - crop_width, None)
+    cropped = pixels[..., top, left, :]
+    mirrored, flipped, rotated = cropped[..., :, ::-1, :], cropped[..., ::-1, :, :], cropped[..., ::-1, ::-1, :]
+    # 依次为左上、右上、左下、右下
+    tiles = {"q1": (cropped, mirrored, flipped, rotated), "q2": (mirrored, cropped, rotated, flipped),
+             "q3": (rotated, flipped, mirrored, cropped), "q4": (flipped, rotated, cropped, mirrored)}[side]
+    return numpy.concatenate((numpy.concatenate(tiles[:2], axis=-2), numpy.concatenate(tiles[2:], axis=-2)), axis=-3)
+
+
+def bench_numpy_mirror(frame_count: int = 60, size: tuple = (800, 600), repeat: int = 3) -> dict:
+    """
+    Pillow 逐帧镜像与 NumPy 切片镜像（逐帧、整叠帧）的对比，先检查两者逐位一致。
+    这是 NumPy 引擎没有合入处理流程的依据：Pillow 的 C 实现逐帧已经更快。
+    """
+    if numpy is None:
+        print("numpy not installed, skipping numpy mirror benchmark")
+        return {}
+    frames = make_frames(frame_count, size)
+    width, height = size
+    crop_width, crop_height = crop_size(width, height, 50, 50)
+    for side in SIDES:
+        expected = numpy.asarray(mirror_frame(frames[0], side))
+        assert numpy.array_equal(numpy_mirror(numpy.asarray(frames[0]), crop_width, crop_height, width, height, side),
+                                 expected), side
+
+    def pillow_frames():
+        for frame in frames:
+            mirror_frame(frame, "q1")
+
+    def numpy_frames():
+        for frame in frames:
+            Image.fromarray(numpy_mirror(numpy.asarray(frame), crop_width, crop_height, width, height, "q1"), 'RGBA')
+
+    def numpy_stack():
+        stack = numpy.stack([numpy.asarray(frame) for frame in frames])
+        for pixels in numpy_mirror(stack, crop_width, crop_height, width, height, "q1"):
+            Image.fromarray(pixels, 'RGBA')
+
+    results = {}
+    for name, func in (("pillow", pillow_frames), ("numpy", numpy_frames), ("numpy_stack", numpy_stack)):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = best
+        print(f"{name:12s} {best * 1000 / frame_count:8.3f} ms/frame")
+    print(f"speedup: {results['pillow'] / results['numpy']:.2f}x per frame, "
+          f"{results['pillow'] / results['numpy_stack']:.2f}x stacked ({frame_count} frames, {width}x{height}, q1)")
+    return results
+
+
+def bench_palette(frame_count: int = 60, size: tuple = (480, 360), side: str = "left"):
+    """
+    对比逐帧 ADAPTIVE 量化与共享全局调色板的耗时、输出大小和颜色偏差。
+    源帧的颜色在全局调色板的抽样窗口之后改变（见 make_palette_shift_gif），偏差为每帧任一通道的最大偏差，
+    分别给出抽样窗口内和窗口之后的最大值。
+    """
+    content = make_palette_shift_gif(frame_count, size, gradient=True)
+    shift_at = PALETTE_SAMPLE_FRAMES + 1
+    results = {}
+    for palette_mode in ("adaptive", "global"):
+        image = Image.open(io.BytesIO(content))
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            frames, durations, _ = process_animated_image(image, 60, 40, side, palette_mode, keep_indexed=False)
+        elapsed = time.perf_counter() - start
+        output = io.BytesIO()
+        frames[0].save(output, format='GIF', save_all=True, append_images=frames[1:],
+                       duration=durations, disposal=2, loop=0)
+        errors = frame_color_errors(content, side, palette_mode)
+        results[palette_mode] = (elapsed, output.tell(), errors)
+        print(f"{palette_mode:12s} {elapsed * 1000 / frame_count:8.3f} ms/frame {output.tell():10d} bytes"
+              f"  max error {max(errors[:shift_at]):3d} before / {max(errors[shift_at:]):3d} after frame {shift_at}")
+        print(f"{'':12s} per-frame error: {' '.join(str(error) for error in errors)}")
+    print(f"speedup: {results['adaptive'][0] / results['global'][0]:.2f}x ({frame_count} frames, {size[0]}x{size[1]})")
+    return results
+
+
+SIDES = ("left", "right", "up", "down", "q1", "q2", "q3", "q4")
+
+
+def make_disposal_gif(disposals: list, size: tuple = (40, 24)) -> bytes:
+    """
+    每帧在透明背景上画一个色块，色块逐帧右移，disposal 按 disposals 指定
+    """
+    width, height = size
+    block = width // len(disposals)
+    frames = []
+    for index in range(len(disposals)):
+        frame = Image.new('P', size, 0)
+        frame.putpalette([0, 0, 0, 255, 0, 0, 0, 255, 0, 0, 0, 255])
+        frame.paste(index % 3 + 1, (index * block, 0, (index + 1) * block, height // 2))
+        frames.append(frame)
+    buffer = io.BytesIO()
+    frames[0].save(buffer, format='GIF', save_all=True, append_images=frames[1:], duration=50, loop=0,
+                   disposal=disposals, transparency=0, optimize=False)
+    return buffer.getvalue()
+
+
+def visible_pixels(frame: Image.Image) -> bytes:
+    # 透明像素的颜色不影响显示，统一清零后再比较
+    frame = frame.convert('RGBA')
+    transparent = frame.getchannel('A').point(lambda a: 255 if a == 0 else 0)
+    frame.paste((0, 0, 0, 0), mask=transparent)
+    return frame.tobytes()
+
+
+def check_disposal() -> int:
+    """
+    残影回归检查：各种 disposal 组合下，输出动画的每一帧都应与源动画对应帧镜像后的画面一致。
+    GIF 输出经过编码再解码比较，WebP/APNG 路径（palette_mode="none"）直接比较。返回比较的帧数。
+    """
+    cases = ([1, 1, 1, 1], [2, 2, 2, 2], [1, 2, 1, 1], [1, 3, 1, 1], [3, 3, 3, 3], [0, 2, 3, 1])
+    compared = 0
+    for disposals in cases:
+        content = make_disposal_gif(disposals)
+        for side in SIDES:
+            expected = [visible_pixels(mirror_frame(frame.convert('RGBA'), side, 60, 40))
+                        for frame in iter_frames(Image.open(io.BytesIO(content)))]
+            encoded = b"".join(encode_gif_stream(iter_animated_image(Image.open(io.BytesIO(content)), 60, 40, side)))
+            truecolor = iter_animated_image(Image.open(io.BytesIO(content)), 60, 40, side, palette_mode="none")
+            # GIF 编码器会把与上一帧相同的帧合并到上一帧，按时长展开后逐帧比较
+            decoded = [visible_pixels(frame) for frame in iter_frames(Image.open(io.BytesIO(encoded)))
+                       for _ in range(frame.info['duration'] // 50)]
+            assert decoded == expected, (disposals, side, "gif")
+            assert [visible_pixels(frame) for frame, _, _ in truecolor] == expected, (disposals, side, "none")
+            compared += 2 * len(expected)
+    print(f"disposal: {compared} frames match the source")
+    return compared
+
+
+def make_palette_shift_gif(frame_count: int = 20, size: tuple = (96, 64), shift_at: int = PALETTE_SAMPLE_FRAMES + 1,
+                           gradient: bool = False) -> bytes:
+    """
+    每帧使用自己的局部调色板（背景色逐帧变化），从 shift_at 帧开始换成一组全新的颜色，
+    这些颜色不在全局调色板的抽样窗口内。gradient 时叠加渐变，样本颜色超过 255 种，全局调色板需要量化。
+    """
+    width, height = size
+    frames = []
+    for index in range(frame_count):
+        if index < shift_at:
+            colors = [(200, 30, 30), (30, 200, 30), (240, 240, 240)]
+        else:
+            colors = [(14, 113, 224), (250, 200, 20), (0, 180, 170)]
+        frame = Image.new('RGB', size, (index * 12 % 256, 40, 90))
+        if gradient:
+            frame = Image.merge('RGB', (Image.linear_gradient('L').resize(size), Image.new('L', size, 40),
+                                        Image.linear_gradient('L').rotate(90).resize(size)))
+        for position, color in enumerate(colors):
+            left = position * width // 4 + index % 4
+            frame.paste(color, (left, height // 8, left + width // 5, height * 7 // 8))
+        frames.append(frame.convert('P', palette=Image.Palette.ADAPTIVE, colors=255 if gradient else 8))
+    buffer = io.BytesIO()
+    frames[0].save(buffer, format='GIF', save_all=True, append_images=frames[1:], duration=50, loop=0, disposal=1,
+                   optimize=False)
+    return buffer.getvalue()
+
+
+def frame_color_errors(content: bytes, side: str, palette_mode: str = "global") -> list:
+    """
+    palette_mode 路径输出的每一帧与源帧镜像后的画面相比，任一通道的最大偏差
+    """
+    expected = [mirror_frame(frame.convert('RGBA'), side, 60, 40).convert('RGB')
+                for frame in iter_frames(Image.open(io.BytesIO(content)))]
+    errors = []
+    output = iter_animated_image(Image.open(io.BytesIO(content)), 60, 40, side, palette_mode)
+    for (frame, _, _), reference in zip(output, expected):
+        extrema = ImageChops.difference(frame.convert('RGB'), reference).getextrema()
+        errors.append(max(high for _, high in extrema))
+    return errors
+
+
+def check_palette_shift() -> int:
+    """
+    全局调色板回归检查：抽样窗口之后出现的新颜色不能被映射到相距很远的调色板颜色上。
+    源帧颜色很少，每一帧都应与源帧完全一致。返回比较的帧数。
+    """
+    content = make_palette_shift_gif()
+    compared = 0
+    for side in SIDES:
+        errors = frame_color_errors(content, side)
+        assert max(errors) == 0, (side, errors)
+        compared += len(errors)
+    print(f"palette shift: {compared} frames match the source colors")
+    return compared
+
+
+def make_oriented(orientation: int, image_format: str, size: tuple = (97, 61)) -> bytes:
+    """
+    生成带 EXIF orientation 的静态图像，像素按原始方向保存
+    """
+    frame = make_frames(1, size)[0].convert('RGB')
+    exif = Image.Exif()
+    exif[ORIENTATION_TAG] = orientation
+    buffer = io.BytesIO()
+    frame.save(buffer, format=image_format, exif=exif)
+    return buffer.getvalue()
+
+
+def check_orientation() -> int:
+    """
+    EXIF orientation 的一致性检查：转正与镜像合并的服务端路径（只解码区域、批量、上传缓存）
+    与先 ImageOps.exif_transpose 转正整幅图像再镜像的结果一致。覆盖 8 种方向、所有方向的镜像和自动缩小。
+    """
+    import main
+
+    compared = 0
+    for image_format in ('PNG', 'JPEG'):
+        for orientation in range(1, 9):
+            content = make_oriented(orientation, image_format)
+            raw_size = Image.open(io.BytesIO(content)).size
+            for target_size in (None, (raw_size[0] // 2, raw_size[1] // 2)):
+                image = Image.open(io.BytesIO(content))
+                upright = ImageOps.exif_transpose(load_image_scaled(image, target_size)) if target_size else \
+                    ImageOps.exif_transpose(image)
+                decoded, _ = main.decode_source(content, False, target_size)
+                specs = [(side, 37, 64) for side in SIDES]
+                batch = main.render_batch(content, specs, 'png', False, target_size)
+                # 自动缩小时，只缩放区域与缩放整幅图像再裁切之间有 ±1 的定点舍入差异
+                tolerance = 1 if target_size else 0
+                for (side, horizontal, vertical), batch_result in zip(specs, batch):
+                    expected = process_static_image(upright, horizontal, vertical, side)
+                    for data in (main.render_static_image(content, horizontal, vertical, side, 'png', target_size),
+                                 main.render_static_image(decoded, horizontal, vertical, side, 'png'),
+                                 batch_result):
+                        actual = Image.open(io.BytesIO(data)).convert('RGBA')
+                        assert actual.size == expected.size, (image_format, orientation, target_size, side)
+                        extrema = ImageChops.difference(actual, expected).getextrema()
+                        assert max(high for _, high in extrema) <= tolerance, \
+                            (image_format, orientation, target_size, side)
+                        compared += 1
+    print(f"orientation: {compared} results match exif_transpose")
+    return compared
+
+
+STAGES = ("decode", "convert", "mirror", "quantize", "encode")
+BASELINE_PATH = "benchmark_baseline.json"
+
+
+def workload_matrix(quick: bool = False) -> list:
+    """
+    返回 (名称, 生成参数) 列表。quick 模式只保留较小的输入，适合提交前快速检查。
+    """
+    if quick:
+        return [
+            ("jpeg-1mp", ("static", 1, 'JPEG')),
+            ("png-1mp", ("static", 1, 'PNG')),
+            ("gif-10f-alpha-d2", ("gif", 10, True, 2)),
+            ("gif-100f-opaque-d1", ("gif", 100, False, 1)),
+        ]
+    return [
+        ("jpeg-1mp", ("static", 1, 'JPEG')),
+        ("jpeg-4mp", ("static", 4, 'JPEG')),
+        ("jpeg-12mp", ("static", 12, 'JPEG')),
+        ("png-1mp", ("static", 1, 'PNG')),
+        ("png-4mp", ("static", 4, 'PNG')),
+        ("gif-10f-alpha-d2", ("gif", 10, True, 2)),
+        ("gif-100f-alpha-d2", ("gif", 100, True, 2)),
+        ("gif-100f-opaque-d1", ("gif", 100, False, 1)),
+        ("gif-1000f-alpha-d1", ("gif", 1000, True, 1)),
+    ]
+
+
+def generate_workload(spec: tuple) -> bytes:
+    if spec[0] == "static":
+        return make_static(spec[1], spec[2])
+    return make_gif(spec[1], (320, 240), transparent=spec[2], disposal=spec[3])
+
+
+def mirror_frame(frame: Image.Image, side: str, horizontal_crop_percent: int = 50, vertical_crop_percent: int = 50):
+    width, height = frame.size
+    crop_width, crop_height = crop_size(width, height, horizontal_crop_percent, vertical_crop_percent)
+    if side in ("left", "right"):
+        canvas = Image.new('RGBA', (crop_width * 2, height), (0, 0, 0, 0))
+        return crop_mirror_image(frame, canvas, crop_width, crop_height, width, height, side)
+    if side in ("up", "down"):
+        canvas = Image.new('RGBA', (width, crop_height * 2), (0, 0, 0, 0))
+        return crop_mirror_image(frame, canvas, crop_width, crop_height, width, height, side)
+    canvas = Image.new('RGBA', (crop_width * 2, crop_height * 2), (0, 0, 0, 0))
+    return quadrant_mirror_image(frame, canvas, crop_width, crop_height, width, height, side)
+
+
+def time_static_stages(content: bytes, side: str) -> dict:
+    timings = dict.fromkeys(STAGES, 0.0)
+    start = time.perf_counter()
+    image = Image.open(io.BytesIO(content))
+    image_format = image.format
+    image.load()
+    timings["decode"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    current = image.convert('RGBA')
+    timings["convert"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = mirror_frame(current, side)
+    timings["mirror"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if image_format == 'JPEG':
+        result = result.convert('RGB')
+    result.save(io.BytesIO(), format=image_format)
+    timings["encode"] = time.perf_counter() - start
+    timings["units"] = image.width * image.height / 1_000_000
+    return timings
+
+
+def time_animated_stages(content: bytes, side: str) -> dict:
+    """
+    通过 image_process.stage_observer 收集服务端动画路径（与 main.render_animation 相同的
+    iter_animated_image + encode_gif_stream）各阶段的耗时，调色板快速路径和编码优化都计算在内
+    """
+    timings = dict.fromkeys(STAGES, 0.0)
+
+    def observe(stage: str, seconds: float):
+        timings[stage] += seconds
+
+    previous = image_process.stage_observer
+    image_process.stage_observer = observe
+    try:
+        image = Image.open(io.BytesIO(content))
+        for _ in encode_gif_stream(iter_animated_image(image, 50, 50, side)):
+            pass
+    finally:
+        image_process.stage_observer = previous
+    timings["units"] = image.n_frames
+    return timings
+
+
+def run_stage_workload(kind: str, content: bytes, repeat: int) -> dict:
+    """
+    在独立子进程中运行一个输入的全部方向，返回各方向最快一次的阶段耗时和子进程的峰值 RSS
+    """
+    timer = time_static_stages if kind == "static" else time_animated_stages
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for side in SIDES:
+            runs = [timer(content, side) for _ in range(repeat)]
+            results[side] = min(runs, key=lambda timings: sum(timings[stage] for stage in STAGES))
+    # Linux 上 ru_maxrss 的单位是 KB
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {"sides": results, "peak_rss_mb": peak_rss_mb}
+
+
+def bench_stages(quick: bool = False, repeat: int = 1) -> dict:
+    """
+    对每种输入和每个方向计时各阶段。每个输入在新的子进程中运行，峰值 RSS 互不影响。
+    返回 {"输入名/方向": {"total": 秒, 各阶段: 秒, "throughput": ...}, "输入名": {"peak_rss_mb": ...}}
+    """
+    report = {}
+    context = multiprocessing.get_context("spawn")
+    for name, spec in workload_matrix(quick):
+        content = generate_workload(spec)
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(run_stage_workload, spec[0], content, repeat).result()
+        unit = "MP/s" if spec[0] == "static" else "frames/s"
+        print(f"{name}  ({len(content) / 1024:.0f} KB, peak RSS {result['peak_rss_mb']:.1f} MB)")
+        report[name] = {"peak_rss_mb": result["peak_rss_mb"]}
+        for side, timings in result["sides"].items():
+            total = sum(timings[stage] for stage in STAGES)
+            throughput = timings["units"] / total if total > 0 else 0.0
+            report[f"{name}/{side}"] = {"total": total, "throughput": throughput,
+                                        **{stage: timings[stage] for stage in STAGES}}
+            stages = " ".join(f"{stage} {timings[stage] * 1000:8.2f}" for stage in STAGES)
+            print(f"  {side:5s} total {total * 1000:9.2f} ms | {stages} | {throughput:8.2f} {unit}")
+    return report
+
+
+def bench_load(requests_count: int = 64, concurrency: int = None, quick: bool = False) -> dict:
+    """
+    端到端压测：在本进程内启动 FastAPI 应用（含 lifespan 和工作池），用 httpx 的 ASGI 传输并发发送请求。
+    关闭限流，并把结果缓存容量设为 0，每个请求都会真正处理。
+    concurrency 默认等于工作池的排队上限；超过上限的请求会收到 503，统计在 statuses 中。
+    """
+    import httpx
+    import main
+    from cache import ResultCache
+    from rate_limit import RateLimiter, MemoryRateLimitBackend
+
+    concurrency = concurrency or main.PROCESS_QUEUE_SIZE
+    main.rate_limiter = RateLimiter(MemoryRateLimitBackend(main.MAX_RATE_LIMIT_CLIENTS), float("inf"), 60, {})
+    main.result_cache = ResultCache(tempfile.mkdtemp(prefix="bench-cache-"), 0, 0, 0)
+    uploads = [
+        ("image.jpg", make_static(1 if quick else 4, 'JPEG')),
+        ("image.gif", make_gif(20 if quick else 60, (320, 240))),
+    ]
+
+    async def run() -> tuple:
+        latencies = []
+        statuses = {}
+        semaphore = asyncio.Semaphore(concurrency)
+        transport = httpx.ASGITransport(app=main.app)
+        async with main.lifespan(main.app):
+            async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=120) as client:
+                async def one(index: int):
+                    file_name, content = uploads[index % len(uploads)]
+                    data = {"horizontal_crop_percent": "50", "vertical_crop_percent": "50",
+                            "selected_side": SIDES[index % len(SIDES)]}
+                    async with semaphore:
+                        start = time.perf_counter()
+                        response = await client.post("/process-image", files={"file": (file_name, content)},
+                                                     data=data)
+                        await response.aread()
+                        latencies.append(time.perf_counter() - start)
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+                start = time.perf_counter()
+                await asyncio.gather(*(one(index) for index in range(requests_count)))
+                return time.perf_counter() - start, latencies, statuses
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        elapsed, latencies, statuses = asyncio.run(run())
+    latencies.sort()
+    report = {
+        "requests": requests_count,
+        "concurrency": concurrency,
+        "requests_per_second": requests_count / elapsed,
+        "p50": statistics.median(latencies),
+        "p95": latencies[int(len(latencies) * 0.95) - 1],
+        "p99": latencies[int(len(latencies) * 0.99) - 1],
+        "statuses": statuses,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    print(f"load: {requests_count} requests, concurrency {concurrency}: {report['requests_per_second']:.2f} req/s, "
+          f"p50 {report['p50'] * 1000:.1f} ms, p95 {report['p95'] * 1000:.1f} ms, p99 {report['p99'] * 1000:.1f} ms, "
+          f"statuses {statuses}, peak RSS {report['peak_rss_mb']:.1f} MB")
+    return report
+
+
+def compare_baseline(report: dict, baseline: dict, tolerance: float) -> list:
+    """
+    与保存的基准比较，返回比基准慢 tolerance 以上（或峰值 RSS 高出 tolerance 以上）的条目
+    """
+    regressions = []
+    for key, current in report.items():
+        expected = baseline.get(key)
+        if expected is None:
+            continue
+        for metric in ("total", "peak_rss_mb", "p95"):
+            if metric in current and metric in expected and current[metric] > expected[metric] * (1 + tolerance):
+                regressions.append(f"{key} {metric}: {expected[metric]:.4f} -> {current[metric]:.4f} "
+                                   f"(+{(current[metric] / expected[metric] - 1) * 100:.0f}%)")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="图像镜像服务基准测试")
+    parser.add_argument("--quick", action="store_true", help="只运行较小的输入")
+    parser.add_argument("--repeat", type=int, default=1, help="每个方向重复次数，取最快一次")
+    parser.add_argument("--skip-load", action="store_true", help="跳过端到端压测")
+    parser.add_argument("--micro", action="store_true", help="同时运行单项对比（单次镜像、调色板、NumPy 镜像）和残影、调色板、方向检查")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="基准文件路径")
+    parser.add_argument("--save-baseline", action="store_true", help="把本次结果保存为基准")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="允许的相对退化比例")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.micro:
+        bench_quadrant()
+        bench_palette()
+        bench_numpy_mirror()
+        check_disposal()
+        check_palette_shift()
+        check_orientation()
+
+    report = bench_stages(args.quick, args.repeat)
+    if not args.skip_load:
+        report["load"] = bench_load(quick=args.quick)
+    report["_meta"] = {"python": platform.python_version(), "machine": platform.machine(),
+                       "cpus": os.cpu_count(), "quick": args.quick}
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f"baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_baseline(report, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            raise SystemExit(1)
+        print(f"no regressions against {args.baseline} (tolerance {args.tolerance * 100:.0f}%)")
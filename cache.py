@@ -0,0 +1,286 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+
+def content_digest(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+# 处理流程的版本，任何改变输出内容的修改都要递增，磁盘上旧流程生成的结果不会再被命中
+PIPELINE_VERSION = 3
+
+
+def make_cache_key(digest: str, horizontal_crop_percent: int, vertical_crop_percent: int, selected_side: str,
+                   variant: str = "") -> str:
+    """
+    内容寻址的缓存键：流程版本、上传内容的哈希加上归一化后的处理参数，variant 区分输出格式和编码参数
+    """
+    key = f"v{PIPELINE_VERSION}-{digest}-{selected_side}-{horizontal_crop_percent}-{vertical_crop_percent}"
+    return f"{key}-{variant}" if variant else key
+
+
+class ResultCache:
+    """
+    处理结果缓存，分为内存和磁盘两层，都按总字节数做 LRU 淘汰。
+    内存层淘汰的条目仍保留在磁盘层；命中磁盘层时会重新放回内存层。
+    多个 worker 共用缓存目录但各自维护磁盘层索引，rescan_disk 定期按目录内容重建索引，
+    收录其他 worker 写入的结果并按整个目录的大小淘汰，目录总量只会在两次重建之间短暂超出上限。
+    """
+    def __init__(self, cache_dir: str, max_memory_bytes: int, max_disk_bytes: int, max_entry_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.lock = threading.Lock()
+        # key -> (data, image_format)
+        self.memory: "OrderedDict[str, Tuple[bytes, str]]" = OrderedDict()
+        self.memory_bytes = 0
+        # key -> (file_name, size)
+        self.disk: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+        self.disk_bytes = 0
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.load_disk_index()
+
+    def load_disk_index(self):
+        # 重启后按修改时间重建磁盘层索引，最旧的排在最前面
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith(".tmp"):
+                # 上次未写完的文件。启动时 worker 还没有 fork，不会删掉正在写入的文件
+                os.remove(os.path.join(self.cache_dir, file_name))
+        for key, file_name, size in self.scan_disk():
+            self.disk[key] = (file_name, size)
+            self.disk_bytes += size
+        self.evict_disk()
+
+    def scan_disk(self) -> list:
+        """
+        列出缓存目录中已写完的结果，按修改时间从旧到新排列
+        """
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            key, _, image_format = file_name.rpartition(".")
+            if not key or file_name.endswith(".tmp"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, file_name))
+            except OSError:
+                # 扫描期间被其他 worker 淘汰
+                continue
+            entries.append((stat.st_mtime, key, file_name, stat.st_size))
+        return [(key, file_name, size) for _, key, file_name, size in sorted(entries)]
+
+    def rescan_disk(self):
+        """
+        按目录内容重建磁盘层索引：其他 worker 写入的结果按修改时间排在最前面，
+        本进程索引中仍存在的条目保持原来的 LRU 顺序排在后面，已被删除的条目移出索引
+        """
+        entries = self.scan_disk()
+        with self.lock:
+            on_disk = {key: (file_name, size) for key, file_name, size in entries}
+            disk = OrderedDict((key, on_disk[key]) for key, _, _ in entries if key not in self.disk)
+            for key in self.disk:
+                if key in on_disk:
+                    disk[key] = on_disk[key]
+            self.disk = disk
+            self.disk_bytes = sum(size for _, size in disk.values())
+            self.evict_disk()
+
+    def get(self, key: str) -> Optional[Tuple[bytes, str]]:
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+                self.hits_memory += 1
+                return entry
+            disk_entry = self.disk.get(key)
+            if disk_entry is None:
+                self.misses += 1
+                return None
+            self.disk.move_to_end(key)
+            file_name, _ = disk_entry
+
+        path = os.path.join(self.cache_dir, file_name)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # 更新修改时间，其他 worker 重建索引时按最近使用排序
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.forget_disk(key)
+                self.misses += 1
+            return None
+
+        image_format = file_name.rpartition(".")[2]
+        with self.lock:
+            self.hits_disk += 1
+            self.store_memory(key, data, image_format)
+        return data, image_format
+
+    def put(self, key: str, data: bytes, image_format: str):
+        if len(data) > self.max_entry_bytes:
+            return
+        file_name = f"{key}.{image_format}"
+        path = os.path.join(self.cache_dir, file_name)
+        # 多个 worker 可能同时写入同一个键，临时文件名带上进程号和随机后缀，互不覆盖
+        temp_path = f"{path}.{os.getpid()}-{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        with self.lock:
+            self.stores += 1
+            self.store_memory(key, data, image_format)
+            self.forget_disk(key)
+            self.disk[key] = (file_name, len(data))
+            self.disk_bytes += len(data)
+            self.evict_disk()
+
+    def store_memory(self, key: str, data: bytes, image_format: str):
+        old = self.memory.pop(key, None)
+        if old is not None:
+            self.memory_bytes -= len(old[0])
+        self.memory[key] = (data, image_format)
+        self.memory_bytes += len(data)
+        while self.memory_bytes > self.max_memory_bytes and self.memory:
+            _, (evicted, _) = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+            self.evictions += 1
+
+    def forget_disk(self, key: str):
+        entry = self.disk.pop(key, None)
+        if entry is not None:
+            self.disk_bytes -= entry[1]
+
+    def evict_disk(self):
+        while self.disk_bytes > self.max_disk_bytes and self.disk:
+            key, (file_name, size) = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.cache_dir, file_name))
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits_memory + self.hits_disk + self.misses
+            return {
+                "memory_entries": len(self.memory),
+                "memory_bytes": self.memory_bytes,
+                "disk_entries": len(self.disk),
+                "disk_bytes": self.disk_bytes,
+                "hits_memory": self.hits_memory,
+                "hits_disk": self.hits_disk,
+                "misses": self.misses,
+                "hit_rate": (self.hits_memory + self.hits_disk) / lookups if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+            }
+
+
+class CachedSource:
+    """
+    已上传的源图像。静态图像保存解码后的 Image，动画保存原始字节（GIF/WebP 本身就是帧的紧凑形式）。
+    size 在放入缓存时计入总量，放入后不应再修改 decoded 和 proxy。
+    """
+    def __init__(self, content: bytes, digest: str, image_format: str, is_animated: bool, decoded=None, proxy=None,
+                 target_size: Optional[Tuple[int, int]] = None, frame_count: int = 1,
+                 dimensions: Optional[Tuple[int, int]] = None, mode: str = "RGBA"):
+        self.content = content
+        self.digest = digest
+        self.image_format = image_format
+        self.is_animated = is_animated
+        # 文件头中的原始尺寸和模式
+        self.dimensions = dimensions
+        self.mode = mode
+        # 超出像素预算、需要自动缩小时的目标尺寸
+        self.target_size = target_size
+        self.frame_count = frame_count
+        self.decoded = decoded
+        # 预览用的缩小代理图
+        self.proxy = proxy
+        self.last_access = time.monotonic()
+
+    @property
+    def size(self) -> int:
+        size = len(self.content)
+        for image in (self.decoded, self.proxy):
+            if image is not None:
+                width, height = image.size
+                size += width * height * len(image.getbands())
+        return size
+
+
+class SourceCache:
+    """
+    按 source_id 保存上传的源图像，按总字节数做 LRU 淘汰，并在 ttl_seconds 未访问后过期。
+    LRU 顺序即最后访问时间顺序，过期清理只需从最旧的一端弹出。
+    """
+    def __init__(self, max_bytes: int, ttl_seconds: float):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.sources: "OrderedDict[str, CachedSource]" = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def put(self, source: CachedSource, source_id: Optional[str] = None) -> str:
+        """
+        source_id 为空时生成新的 id；从其他 worker 的共享存储中恢复时沿用原来的 id
+        """
+        source_id = source_id or uuid.uuid4().hex
+        with self.lock:
+            source.last_access = time.monotonic()
+            previous = self.sources.pop(source_id, None)
+            if previous is not None:
+                self.total_bytes -= previous.size
+            self.sources[source_id] = source
+            self.total_bytes += source.size
+            self.evict()
+        return source_id
+
+    def get(self, source_id: str) -> Optional[CachedSource]:
+        with self.lock:
+            self.evict()
+            source = self.sources.get(source_id)
+            if source is None:
+                self.misses += 1
+                return None
+            source.last_access = time.monotonic()
+            self.sources.move_to_end(source_id)
+            self.hits += 1
+            return source
+
+    def evict(self):
+        expire_before = time.monotonic() - self.ttl_seconds
+        while self.sources:
+            source_id, oldest = next(iter(self.sources.items()))
+            if self.total_bytes <= self.max_bytes and oldest.last_access >= expire_before:
+                break
+            del self.sources[source_id]
+            self.total_bytes -= oldest.size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.sources),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
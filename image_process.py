@@ -1,14 +1,41 @@
-from PIL import Image, ImageOps, ImageSequence
+from PIL import Image, ImageChops, ImageOps, GifImagePlugin
 from PIL import Image, ExifTags
+import argparse
+import glob
+import hashlib
 import io
+import json
+import logging
+import math
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+logger = logging.getLogger(__name__)
+
+# 阶段耗时回调 stage_observer(stage, seconds)，由服务端设置为指标收集函数；为 None 时不记录
+stage_observer = None
+
+
+def record_stage(stage: str, start: float):
+    """
+    记录从 start（time.perf_counter() 的返回值）到现在的阶段耗时
+    """
+    if stage_observer is not None:
+        stage_observer(stage, time.perf_counter() - start)
+
+
+# 只有局部调色板与全局调色板不同时才把 GIF 帧转换为 RGB(A)，
+# 其余帧保持 P 模式，供调色板快速路径使用；其他路径都会自行 convert('RGBA')，不受影响
+GifImagePlugin.LOADING_STRATEGY = GifImagePlugin.LoadingStrategy.RGB_AFTER_DIFFERENT_PALETTE_ONLY
 
 
 def crop_mirror_image(image: Image.Image, new_canvas: Image.Image,
                       crop_width: int, crop_height: int, width: int, height: int,
                       side: str):
     result = new_canvas
-    print(f"crop_width: {crop_width}, crop_height: {crop_height}, width: {width}, height: {height}, side: {side}")
+    logger.debug("crop_width: %s, crop_height: %s, width: %s, height: %s, side: %s",
+                 crop_width, crop_height, width, height, side)
     if side == "left":
         cropped = image.crop((0, 0, crop_width, height))
         mirrored = ImageOps.mirror(cropped)
@@ -30,17 +57,67 @@ def crop_mirror_image(image: Image.Image, new_canvas: Image.Image,
         result.paste(mirrored, (0, 0))
         result.paste(cropped, (0, crop_height))
     else:
-        raise ValueError(f"Invalid selected_side: {selected_side}")
+        raise ValueError(f"Invalid selected_side: {side}")
+
+    return result
+
+
+def quadrant_mirror_image(image: Image.Image, new_canvas: Image.Image,
+                          crop_width: int, crop_height: int, width: int, height: int,
+                          side: str):
+    """
+    万花筒（q1-q4）单次处理：只裁切一次源象限，
+    由同一块裁切结果的镜像、翻转和旋转直接拼成 2x2 画布，不再生成中间画布。
+    """
+    result = new_canvas
+    if side == "q1":
+        box = (0, 0, crop_width, crop_height)
+    elif side == "q2":
+        box = (width - crop_width, 0, width, crop_height)
+    elif side == "q3":
+        box = (width - crop_width, height - crop_height, width, height)
+    elif side == "q4":
+        box = (0, height - crop_height, crop_width, height)
+    else:
+        raise ValueError(f"Invalid selected_side: {side}")
+
+    cropped = image.crop(box)
+    if cropped.mode != result.mode:
+        # 只转换一次，避免每次 paste 时重复转换
+        cropped = cropped.convert(result.mode)
+    mirrored = cropped.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    flipped = cropped.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+    rotated = cropped.transpose(Image.Transpose.ROTATE_180)
+
+    if side == "q1":
+        tiles = (cropped, mirrored, flipped, rotated)
+    elif side == "q2":
+        tiles = (mirrored, cropped, rotated, flipped)
+    elif side == "q3":
+        tiles = (rotated, flipped, mirrored, cropped)
+    else:
+        tiles = (flipped, rotated, cropped, mirrored)
 
+    # 依次为左上、右上、左下、右下
+    result.paste(tiles[0], (0, 0))
+    result.paste(tiles[1], (crop_width, 0))
+    result.paste(tiles[2], (0, crop_height))
+    result.paste(tiles[3], (crop_width, crop_height))
     return result
 
 
+def crop_size(width: int, height: int, horizontal_crop_percent: int, vertical_crop_percent: int) -> tuple:
+    # 保留区域的宽高，至少 1 像素：小图配合很小的比例时不会得到空图像
+    return (max(int(width * horizontal_crop_percent / 100), 1),
+            max(int(height * vertical_crop_percent / 100), 1))
+
+
 def process_static_image(image: Image.Image, horizontal_crop_percent: int, vertical_crop_percent: int, selected_side: str) -> Image.Image:
-    print(f"Processing static image with horizontal_crop_percent={horizontal_crop_percent},"
-          f" vertical_crop_percent={vertical_crop_percent}, selected_side={selected_side}")
+    logger.debug("Processing static image with horizontal_crop_percent=%s, vertical_crop_percent=%s, selected_side=%s",
+                 horizontal_crop_percent, vertical_crop_percent, selected_side)
+    start = time.perf_counter()
     width, height = image.size
-    crop_width = int(width * horizontal_crop_percent / 100)
-    crop_height = int(height * vertical_crop_percent / 100)
+    crop_width, crop_height = crop_size(width, height, horizontal_crop_percent, vertical_crop_percent)
 
     if selected_side == "left" or selected_side == "right":
         new_canvas = Image.new('RGBA', (crop_width * 2, height))
@@ -50,290 +127,809 @@ def process_static_image(image: Image.Image, horizontal_crop_percent: int, verti
         new_canvas = Image.new('RGBA', (width, crop_height * 2))
         new_image = crop_mirror_image(image, new_canvas, crop_width, crop_height, width, height, selected_side)
 
-    elif selected_side == "q1":
-        new_canvas = Image.new('RGBA', (crop_width * 2, height))
-        new_image = crop_mirror_image(image, new_canvas, crop_width, crop_height, width, height, "left")
-        width, height = new_image.size
-        new_canvas = Image.new('RGBA', (width, crop_height * 2))
-        new_image = crop_mirror_image(new_image, new_canvas, crop_width, crop_height, width, height, "up")
+    elif selected_side in ("q1", "q2", "q3", "q4"):
+        new_canvas = Image.new('RGBA', (crop_width * 2, crop_height * 2))
+        new_image = quadrant_mirror_image(image, new_canvas, crop_width, crop_height, width, height, selected_side)
 
-    elif selected_side == "q2":
-        new_canvas = Image.new('RGBA', (crop_width * 2, height))
-        new_image = crop_mirror_image(image, new_canvas, crop_width, crop_height, width, height, "right")
-        width, height = new_image.size
-        new_canvas = Image.new('RGBA', (width, crop_height * 2))
-        new_image = crop_mirror_image(new_image, new_canvas, crop_width, crop_height, width, height, "up")
+    else:
+        raise ValueError(f"Invalid selected_side: {selected_side}")
 
-    elif selected_side == "q3":
-        new_canvas = Image.new('RGBA', (crop_width * 2, height))
-        new_image = crop_mirror_image(image, new_canvas, crop_width, crop_height, width, height, "right")
-        width, height = new_image.size
-        new_canvas = Image.new('RGBA', (width, crop_height * 2))
-        new_image = crop_mirror_image(new_image, new_canvas, crop_width, crop_height, width, height, "down")
+    record_stage("mirror", start)
+    return new_image
 
-    elif selected_side == "q4":
-        new_canvas = Image.new('RGBA', (crop_width * 2, height))
-        new_image = crop_mirror_image(image, new_canvas, crop_width, crop_height, width, height, "left")
-        width, height = new_image.size
-        new_canvas = Image.new('RGBA', (width, crop_height * 2))
-        new_image = crop_mirror_image(new_image, new_canvas, crop_width, crop_height, width, height, "down")
 
+def load_image_scaled(image: Image.Image, target_size: tuple = None) -> Image.Image:
+    """
+    解码静态图像。给定 target_size 时，JPEG 先用 draft 让解码器按 1/2、1/4、1/8 缩小解码，
+    再缩放到目标尺寸，避免先完整解码超大图像。
+    """
+    start = time.perf_counter()
+    if target_size is None:
+        image.load()
     else:
-        raise ValueError(f"Invalid selected_side: {selected_side}")
+        image.draft(image.mode, target_size)
+        if image.size != target_size:
+            image = image.resize(target_size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+        else:
+            image.load()
+    record_stage("decode", start)
+    return image
 
 
-    return new_image
+def source_region(width: int, height: int, horizontal_crop_percent: int, vertical_crop_percent: int,
+                  selected_side: str) -> tuple:
+    """
+    镜像结果实际用到的源图像区域 (left, upper, right, lower)，与 crop_mirror_image、quadrant_mirror_image 的裁切一致
+    """
+    crop_width, crop_height = crop_size(width, height, horizontal_crop_percent, vertical_crop_percent)
+    if selected_side == "left":
+        return 0, 0, crop_width, height
+    elif selected_side == "right":
+        return width - crop_width, 0, width, height
+    elif selected_side == "up":
+        return 0, 0, width, crop_height
+    elif selected_side == "down":
+        return 0, height - crop_height, width, height
+    elif selected_side == "q1":
+        return 0, 0, crop_width, crop_height
+    elif selected_side == "q2":
+        return width - crop_width, 0, width, crop_height
+    elif selected_side == "q3":
+        return width - crop_width, height - crop_height, width, height
+    elif selected_side == "q4":
+        return 0, height - crop_height, crop_width, height
+    raise ValueError(f"Invalid selected_side: {selected_side}")
+
+
+def union_region(boxes: list) -> tuple:
+    return (min(box[0] for box in boxes), min(box[1] for box in boxes),
+            max(box[2] for box in boxes), max(box[3] for box in boxes))
+
+
+def restrict_decode_region(image: Image.Image, box: tuple):
+    """
+    在 load() 之前调整 image.tile，只解码与 box 相交的部分：
+    - 多块（条带、瓦片）图像跳过与 box 不相交的块
+    - 单块逐行编码的图像（非隔行 PNG、未压缩格式）只解码到 box 的下边界（自下而上存储时为上边界）
+    JPEG 解码器没有读完全部扫描行时会报错，只能完整解码。box 以外的像素内容不确定，调用方只能使用 box 内的部分。
+    """
+    left, upper, right, lower = box
+    tiles = image.tile
+    if len(tiles) > 1:
+        image.tile = [tile for tile in tiles
+                      if tile[1][0] < right and tile[1][2] > left and tile[1][1] < lower and tile[1][3] > upper]
+        return
+    if len(tiles) != 1 or image.info.get("interlace"):
+        return
+    codec_name, (x0, y0, x1, y1), offset, args = tiles[0]
+    if codec_name == "raw" and not isinstance(args, str) and len(args) >= 3 and args[2] == -1:
+        # 自下而上存储（例如 BMP、TGA），解码到 box 的上边界就停止
+        if upper > y0:
+            image.tile = [(codec_name, (x0, upper, x1, y1), offset, args)]
+    elif codec_name in ("raw", "zip") and lower < y1:
+        image.tile = [(codec_name, (x0, y0, x1, lower), offset, args)]
+
+
+def load_image_region(image: Image.Image, box: tuple, target_size: tuple = None) -> Image.Image:
+    """
+    只解码并返回 box 覆盖的区域。给定 target_size 时 box 是缩小后的坐标：
+    JPEG 先用 draft 缩小解码，然后只把 box 对应的源区域缩放到 box 的尺寸，结果与先缩放整幅图像再裁切相同。
+    """
+    start = time.perf_counter()
+    if target_size is None or image.size == target_size:
+        restrict_decode_region(image, box)
+        image.load()
+        region = image.crop(box)
+    else:
+        image.draft(image.mode, target_size)
+        scale_x = image.width / target_size[0]
+        scale_y = image.height / target_size[1]
+        source_box = (box[0] * scale_x, box[1] * scale_y, box[2] * scale_x, box[3] * scale_y)
+        # 缩放滤波器会读取区域外相邻的像素，多解码几行几列
+        margin = 3 * math.ceil(max(scale_x, scale_y)) + 1
+        restrict_decode_region(image, (max(int(source_box[0]) - margin, 0), max(int(source_box[1]) - margin, 0),
+                                       math.ceil(source_box[2]) + margin, math.ceil(source_box[3]) + margin))
+        image.load()
+        region = image.resize((box[2] - box[0], box[3] - box[1]), Image.Resampling.BILINEAR, box=source_box,
+                              reducing_gap=2.0)
+    record_stage("decode", start)
+    return region
+
+
+def process_static_image_region(image: Image.Image, horizontal_crop_percent: int, vertical_crop_percent: int,
+                                selected_side: str, target_size: tuple = None) -> Image.Image:
+    """
+    结果与 process_static_image 相同，但 image 尚未解码，只解码镜像需要的源区域，
+    解码开销随裁切区域大小增长，而不是随整幅图像大小增长。
+    带 EXIF orientation 的图像（手机照片）按转正后的方向镜像，转正与镜像合并为一次变换，见 mirror_oriented_region。
+    """
+    orientation = exif_orientation(image)
+    box = source_region_oriented(target_size or image.size, horizontal_crop_percent, vertical_crop_percent,
+                                 selected_side, orientation)
+    region = load_image_region(image, box, target_size)
+    # 区域本身就是要保留的部分，按 100% 镜像
+    return mirror_oriented_region(region, selected_side, orientation)
 
 
-def correct_image_orientation(image):
+def build_preview_proxy(image: Image.Image, max_size: int) -> Image.Image:
+    """
+    生成用于实时预览的缩小代理图：只取第一帧，缩放到 max_size 以内并转换为 RGBA
+    """
+    image.seek(0)
+    proxy = image.convert('RGBA')
+    # 裁切比例按百分比计算，缩小后镜像位置保持一致
+    proxy.thumbnail((max_size, max_size), Image.Resampling.BILINEAR, reducing_gap=2.0)
+    return proxy
+
+
+# EXIF Orientation 标签号，预先取出，不必每次在 ExifTags.TAGS 中查找
+ORIENTATION_TAG = ExifTags.Base.Orientation
+# EXIF orientation -> 转正所需的无损变换（与 ImageOps.exif_transpose 相同），1 不需要变换
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+def compose_transpose_table() -> dict:
+    """
+    (先做的变换, 后做的变换) -> 等价的单次变换，None 表示不变换。
+    八种变换构成一个群，任意两次变换都可以合成为一次；这里用一张像素各不相同的小图实测得到合成结果。
+    """
+    methods = (None,) + tuple(Image.Transpose)
+    probe = Image.frombytes('L', (3, 2), bytes(range(6)))
+
+    def apply(image: Image.Image, method) -> Image.Image:
+        return image if method is None else image.transpose(method)
+
+    results = {}
+    for method in methods:
+        result = apply(probe, method)
+        results[(result.size, result.tobytes())] = method
+    table = {}
+    for first in methods:
+        for second in methods:
+            result = apply(apply(probe, first), second)
+            table[(first, second)] = results[(result.size, result.tobytes())]
+    return table
+
+
+TRANSPOSE_PRODUCTS = compose_transpose_table()
+
+# 各方向镜像结果的拼块：(列, 行), 对保留区域做的变换，与 crop_mirror_image、quadrant_mirror_image 的拼接一致
+MIRROR_TILES = {
+    "left": (((0, 0), None), ((1, 0), Image.Transpose.FLIP_LEFT_RIGHT)),
+    "right": (((0, 0), Image.Transpose.FLIP_LEFT_RIGHT), ((1, 0), None)),
+    "up": (((0, 0), None), ((0, 1), Image.Transpose.FLIP_TOP_BOTTOM)),
+    "down": (((0, 0), Image.Transpose.FLIP_TOP_BOTTOM), ((0, 1), None)),
+    "q1": (((0, 0), None), ((1, 0), Image.Transpose.FLIP_LEFT_RIGHT),
+           ((0, 1), Image.Transpose.FLIP_TOP_BOTTOM), ((1, 1), Image.Transpose.ROTATE_180)),
+    "q2": (((0, 0), Image.Transpose.FLIP_LEFT_RIGHT), ((1, 0), None),
+           ((0, 1), Image.Transpose.ROTATE_180), ((1, 1), Image.Transpose.FLIP_TOP_BOTTOM)),
+    "q3": (((0, 0), Image.Transpose.ROTATE_180), ((1, 0), Image.Transpose.FLIP_TOP_BOTTOM),
+           ((0, 1), Image.Transpose.FLIP_LEFT_RIGHT), ((1, 1), None)),
+    "q4": (((0, 0), Image.Transpose.FLIP_TOP_BOTTOM), ((1, 0), Image.Transpose.ROTATE_180),
+           ((0, 1), None), ((1, 1), Image.Transpose.FLIP_LEFT_RIGHT)),
+}
+
+
+def exif_orientation(image: Image.Image) -> int:
+    """
+    读取 EXIF orientation（1-8），没有或无效时为 1。只使用打开文件时已经读出的数据，不会触发解码：
+    PngImageFile.getexif() 在 eXIf 块位于像素数据之后时会先解码整幅图像，这样的 PNG 按 1 处理。
+    """
     try:
-        exif = image._getexif()
-        if exif:
-            orientation_key = next(
-                (key for key, val in ExifTags.TAGS.items() if val == 'Orientation'), None)
-            if orientation_key and orientation_key in exif:
-                orientation = exif[orientation_key]
-
-                # 根据 Orientation 值旋转图片
-                if orientation == 3:  # 上下颠倒
-                    image = image.rotate(180, expand=True)
-                elif orientation == 6:  # 顺时针 90 度
-                    image = image.rotate(270, expand=True)
-                elif orientation == 8:  # 逆时针 90 度
-                    image = image.rotate(90, expand=True)
-        return image
+        if hasattr(image, "tag_v2"):
+            orientation = image.tag_v2.get(ORIENTATION_TAG, 1)
+        elif "exif" in image.info:
+            exif = Image.Exif()
+            exif.load(image.info["exif"])
+            orientation = exif.get(ORIENTATION_TAG, 1)
+        else:
+            return 1
     except Exception as e:
-        print(f"Error correcting orientation: {e}")
-        return image
+        logger.warning("Error reading EXIF orientation: %s", e)
+        return 1
+    return orientation if orientation in ORIENTATION_TRANSPOSE else 1
+
 
+def oriented_size(size: tuple, orientation: int) -> tuple:
+    # 5-8 需要旋转 90 度或沿对角线翻转，宽高互换
+    return (size[1], size[0]) if orientation >= 5 else size
 
-# another method
-def process_animated_image_spare(image: Image.Image, horizontal_crop_percent: int, vertical_crop_percent: int, selected_side: str) -> tuple:
+
+def unorient_box(box: tuple, size: tuple, orientation: int) -> tuple:
     """
-    修复透明背景和残影问题的 GIF 图片处理函数
-    增加了更严格的颜色处理逻辑，防止白色区域变为透明
+    把转正后图像上的区域换算到原始方向的图像上，size 为原始方向的尺寸
     """
-    frames = []
-    durations = []
-    disposal_methods = []
+    left, upper, right, lower = box
+    width, height = size
+    return {
+        1: (left, upper, right, lower),
+        2: (width - right, upper, width - left, lower),
+        3: (width - right, height - lower, width - left, height - upper),
+        4: (left, height - lower, right, height - upper),
+        5: (upper, left, lower, right),
+        6: (upper, height - right, lower, height - left),
+        7: (width - lower, height - right, width - upper, height - left),
+        8: (width - lower, left, width - upper, right),
+    }[orientation]
+
+
+def source_region_oriented(size: tuple, horizontal_crop_percent: int, vertical_crop_percent: int,
+                           selected_side: str, orientation: int = 1) -> tuple:
+    """
+    转正后镜像用到的区域（见 source_region），换算到原始方向的坐标，可以直接用于解码
+    """
+    width, height = oriented_size(size, orientation)
+    return unorient_box(source_region(width, height, horizontal_crop_percent, vertical_crop_percent, selected_side),
+                        size, orientation)
 
-    width, height = image.size
-    crop_width = int(width * horizontal_crop_percent / 100)
-    crop_height = int(height * vertical_crop_percent / 100)
 
-    print("Original size:", width, height)
-    print("Crop width:", crop_width)
+def mirror_oriented_region(region: Image.Image, selected_side: str, orientation: int = 1) -> Image.Image:
+    """
+    region 是原始方向上镜像要保留的区域（见 source_region_oriented）。结果等于先按 orientation 转正、再按 100% 镜像，
+    但不生成转正后的中间图像：转正和镜像/翻转合成为一次 transpose，每个拼块只变换一次。
+    """
+    transpose = ORIENTATION_TRANSPOSE.get(orientation)
+    if transpose is None:
+        return process_static_image(region, 100, 100, selected_side)
+    tiles = MIRROR_TILES.get(selected_side)
+    if tiles is None:
+        raise ValueError(f"Invalid selected_side: {selected_side}")
 
-    try:
-        previous_frame = None
-        palette = None
-
-        for frame_index, frame in enumerate(ImageSequence.Iterator(image)):
-            duration = frame.info.get('duration', 100)
-            durations.append(duration)
-            disposal_method = getattr(frame, 'disposal_method', 2)
-            disposal_methods.append(disposal_method)
-
-            # 转换为 RGBA 模式，保持原始颜色
-            current = frame.convert('RGBA')
-
-            print(f"Frame {frame_index} original mode:", current.mode)
-
-            # 创建新的透明画布
-            if selected_side == "left" or selected_side == "right":
-                new_frame = Image.new('RGBA', (crop_width * 2, height), (0, 0, 0, 0))
-                new_frame = crop_mirror_image(current, new_frame, crop_width, crop_height, width, height, selected_side)
-
-            elif selected_side == "up" or selected_side == "down":
-                new_frame = Image.new('RGBA', (width, crop_height * 2), (0, 0, 0, 0))
-                new_frame = crop_mirror_image(current, new_frame, crop_width, crop_height, width, height, selected_side)
-
-            elif selected_side == "q1":
-                new_canvas = Image.new('RGBA', (crop_width * 2, height), (0, 0, 0, 0))
-                new_frame = crop_mirror_image(current, new_canvas, crop_width, crop_height, width, height, "left")
-                new_canvas = Image.new('RGBA', (crop_width * 2, crop_height * 2), (0, 0, 0, 0))
-                new_frame = crop_mirror_image(new_frame, new_canvas, crop_width, crop_height, crop_width * 2, height,
-                                              "up")
-
-            elif selected_side == "q2":
-                new_frame = Image.new('RGBA', (crop_width * 2, height), (0, 0, 0, 0))
-                new_frame = crop_mirror_image(current, new_frame, crop_width, crop_height, width, height, "right")
-                new_canvas = Image.new('RGBA', (crop_width * 2, crop_height * 2), (0, 0, 0, 0))
-                new_frame = crop_mirror_image(new_frame, new_canvas, crop_width, crop_height, crop_width * 2, height,
-                                              "up")
-
-            elif selected_side == "q3":
-                new_canvas = Image.new('RGBA', (crop_width * 2, height), (0, 0, 0, 0))
-                new_frame = crop_mirror_image(current, new_canvas, crop_width, crop_height, width, height, "right")
-                new_canvas = Image.new('RGBA', (crop_width * 2, crop_height * 2), (0, 0, 0, 0))
-                new_frame = crop_mirror_image(new_frame, new_canvas, crop_width, crop_height, crop_width * 2, height,
-                                              "down")
-
-            elif selected_side == "q4":
-                new_canvas = Image.new('RGBA', (crop_width * 2, height), (0, 0, 0, 0))
-                new_frame = crop_mirror_image(current, new_canvas, crop_width, crop_height, width, height, "left")
-                width, height = new_frame.size
-                new_canvas = Image.new('RGBA', (crop_width * 2, crop_height * 2), (0, 0, 0, 0))
-                new_frame = crop_mirror_image(new_frame, new_canvas, crop_width, crop_height, crop_width * 2, height,
-                                              "down")
-            else:
-                raise ValueError(f"Invalid selected_side: {selected_side}")
-
-            # 根据 disposal_method 处理残影
-            if (disposal_method == 0 or disposal_method == 1) and previous_frame:
-                new_frame = Image.alpha_composite(previous_frame, new_frame)
-            elif disposal_method == 3 and previous_frame:
-                new_frame = Image.alpha_composite(previous_frame, new_frame)
-
-            # 创建 RGB 图像并处理透明度
-            rgb_frame = Image.new('RGB', new_frame.size, (255, 255, 255))  # 使用白色背景
-            rgb_frame.paste(new_frame, mask=new_frame.split()[3])
-
-            if palette is None:
-                # 第一帧：创建调色板，保留256个颜色位置
-                converted_frame = rgb_frame.convert('P', palette=Image.ADAPTIVE, colors=255)
-                palette = converted_frame.getpalette()
-                # 确保透明色位置的颜色为黑色
-                palette[:3] = [0, 0, 0]
-            else:
-                # 后续帧：使用相同的调色板
-                converted_frame = rgb_frame.convert('P', palette=Image.ADAPTIVE, colors=255)
-                converted_frame.putpalette(palette)
+    start = time.perf_counter()
+    width, height = oriented_size(region.size, orientation)
+    columns = max(column for (column, _), _ in tiles) + 1
+    rows = max(row for (_, row), _ in tiles) + 1
+    result = Image.new('RGBA', (width * columns, height * rows))
+    if region.mode != result.mode:
+        # 只转换一次，避免每次 paste 时重复转换
+        region = region.convert(result.mode)
+    for (column, row), mirror in tiles:
+        method = TRANSPOSE_PRODUCTS[(transpose, mirror)]
+        result.paste(region if method is None else region.transpose(method), (column * width, row * height))
+    record_stage("mirror", start)
+    return result
+
+
+def correct_image_orientation(image: Image.Image, orientation: int = None) -> Image.Image:
+    """
+    按 EXIF orientation 无损转正：transpose 只重排像素，不重采样，支持全部 8 种方向。
+    orientation 为 None 时从 image 读取；缩放等操作会产生新图像，应在解码前读出 orientation 传入。
+    """
+    if orientation is None:
+        orientation = exif_orientation(image)
+    transpose = ORIENTATION_TRANSPOSE.get(orientation)
+    return image if transpose is None else image.transpose(transpose)
+
+
+# 全局调色板中保留给透明色的索引
+TRANSPARENT_INDEX = 255
+PALETTE_SAMPLE_FRAMES = 8
+# 映射到全局调色板后，任一通道偏差超过 PALETTE_MAX_ERROR 的像素视为失真；
+# 失真像素超过 PALETTE_MAX_DISTORTED 比例的帧（通常是抽样窗口之后出现新颜色的帧）改用自己的局部调色板
+PALETTE_MAX_ERROR = 48
+PALETTE_MAX_DISTORTED = 0.005
+
+
+def build_global_palette(sample_frames: list) -> Image.Image:
+    """
+    为整段动画生成一个共享调色板（最多 255 色，索引 255 留给透明色）。
+    镜像和翻转不会产生新颜色，样本帧中颜色不超过 255 种时原样保留（通常即源 GIF 的调色板），
+    超过时对样本做一次中位切分量化。
+    """
+    samples = []
+    for frame in sample_frames:
+        sample = frame.convert('RGB')
+        # 最近邻缩小不会引入新颜色
+        sample.thumbnail((256, 256), Image.Resampling.NEAREST)
+        samples.append(sample)
+
+    montage = Image.new('RGB', (max(s.width for s in samples), sum(s.height for s in samples)))
+    top = 0
+    for sample in samples:
+        montage.paste(sample, (0, top))
+        top += sample.height
+
+    exact_colors = montage.getcolors(maxcolors=TRANSPARENT_INDEX)
+    if exact_colors is not None:
+        colors = [channel for _, color in exact_colors for channel in color]
+    else:
+        quantized = montage.quantize(colors=TRANSPARENT_INDEX, method=Image.Quantize.MEDIANCUT)
+        colors = quantized.getpalette()[:TRANSPARENT_INDEX * 3]
+
+    palette_image = Image.new('P', (1, 1))
+    palette_image.putpalette(colors)
+    return palette_image
 
-            # 更严格的透明度处理
-            alpha = new_frame.split()[3]
-            # 只有完全透明的像素（alpha=0）才会被标记为透明
-            mask = alpha.point(lambda x: 0 if x == 0 else 255)
 
-            # 仅对完全透明的区域应用透明色
-            converted_frame.paste(0, mask=ImageOps.invert(mask))
+def remap_to_palette(frame: Image.Image, palette_image: Image.Image, transparent_mask: Image.Image = None) -> Image.Image:
+    """
+    将一帧映射到共享调色板上，不再逐帧 ADAPTIVE 量化。
+    Pillow 在映射时使用颜色立方缓存查找最近色，transparent_mask 中非零的像素写入透明索引。
+    """
+    if frame.mode != 'RGB':
+        frame = frame.convert('RGB')
+    reduced_frame = frame.quantize(palette=palette_image, dither=Image.Dither.NONE)
 
-            # 保存关键信息
-            converted_frame.info['transparency'] = 0
-            converted_frame.info['duration'] = duration
+    palette = reduced_frame.getpalette()
+    palette += [0, 0, 0] * (256 - len(palette) // 3)
+    reduced_frame.putpalette(palette)
+    if transparent_mask is not None:
+        reduced_frame.paste(TRANSPARENT_INDEX, mask=transparent_mask)
+    reduced_frame.info['transparency'] = TRANSPARENT_INDEX
+    return reduced_frame
 
-            print(f"Frame {frame_index} final mode:", converted_frame.mode)
-            print(f"Frame {frame_index} has transparency:", 'transparency' in converted_frame.info)
 
-            frames.append(converted_frame)
-            previous_frame = new_frame
+def quantize_local(rgb_frame: Image.Image, transparent_mask: Image.Image = None) -> Image.Image:
+    """
+    单独为一帧做中位切分量化（最多 255 色），transparent_mask 中非零的像素写入透明索引
+    """
+    reduced_frame = rgb_frame.quantize(colors=TRANSPARENT_INDEX, method=Image.Quantize.MEDIANCUT)
+    palette = reduced_frame.getpalette()
+    palette += [0, 0, 0] * (256 - len(palette) // 3)
+    reduced_frame.putpalette(palette)
+    if transparent_mask is not None:
+        reduced_frame.paste(TRANSPARENT_INDEX, mask=transparent_mask)
+    reduced_frame.info['transparency'] = TRANSPARENT_INDEX
+    return reduced_frame
+
+
+def palette_distortion(rgb_frame: Image.Image, reduced_frame: Image.Image,
+                       transparent_mask: Image.Image = None) -> float:
+    """
+    映射后失真像素（任一通道偏差超过 PALETTE_MAX_ERROR）占不透明像素的比例
+    """
+    red, green, blue = ImageChops.difference(rgb_frame, reduced_frame.convert('RGB')).split()
+    error = ImageChops.lighter(ImageChops.lighter(red, green), blue)
+    opaque = error.width * error.height
+    if transparent_mask is not None:
+        error.paste(0, mask=transparent_mask)
+        opaque -= transparent_mask.histogram()[255]
+    distorted = sum(error.histogram()[PALETTE_MAX_ERROR + 1:])
+    return distorted / opaque if opaque > 0 else 0.0
+
 
-    except EOFError:
+def alpha_threshold_mask(frame: Image.Image) -> Image.Image:
+    # alpha 低于 128 的像素记为透明
+    return frame.getchannel('A').point(lambda p: 255 if p < 128 else 0)
+
+
+class TruecolorQuantizer:
+    """
+    不量化，直接产出合成后的 RGBA 帧，供动画 WebP/APNG 输出
+    """
+    sample_size = 0
+
+    def prepare(self, sample_frames: list):
         pass
 
-    return frames, durations, disposal_methods
+    def quantize(self, frame: Image.Image) -> Image.Image:
+        return frame
 
 
-def process_animated_image(image: Image.Image, horizontal_crop_percent: int, vertical_crop_percent: int, selected_side: str) -> tuple:
+class AdaptiveQuantizer:
     """
-    修复透明背景和残影问题的 GIF 图片处理函数
+    每帧单独 ADAPTIVE 量化。transparent 为 True（源图有透明色）时，透明像素写入调色板之后的第一个空闲索引。
+    """
+    sample_size = 0
+
+    def __init__(self, transparent: bool = False):
+        self.transparent = transparent
+
+    def prepare(self, sample_frames: list):
+        pass
+
+    def quantize(self, frame: Image.Image) -> Image.Image:
+        reduced_frame = frame.convert('P', palette=Image.ADAPTIVE, colors=255)
+        if self.transparent:
+            palette = reduced_frame.getpalette()
+            transparent_index = len(palette) // 3
+            if transparent_index < 256:
+                palette[transparent_index * 3:transparent_index * 3 + 3] = (0, 0, 0)
+                reduced_frame.putpalette(palette)
+                reduced_frame.paste(transparent_index, mask=alpha_threshold_mask(frame))
+                reduced_frame.info['transparency'] = transparent_index
+        return reduced_frame
+
+
+class GlobalPaletteQuantizer:
+    """
+    整段动画共享一个调色板，避免逐帧量化和颜色闪烁。
+    调色板由前 sample_size 帧生成，不需要为了抽样再解码一遍动画；与上一帧完全相同的帧直接复用映射结果。
+    抽样窗口之后出现的新颜色无法用共享调色板表示，映射失真过大的帧改用自己的局部调色板（见 palette_distortion）。
+    """
+    def __init__(self, sample_size: int = PALETTE_SAMPLE_FRAMES):
+        self.sample_size = sample_size
+        self.palette_image = None
+        self.last_key = None
+        self.last_output = None
+        self.reused = 0
+        self.local_frames = 0
+
+    def prepare(self, sample_frames: list):
+        self.palette_image = build_global_palette(sample_frames)
+
+    def quantize(self, frame: Image.Image) -> Image.Image:
+        mask = alpha_threshold_mask(frame)
+        key = (frame.tobytes(), mask.tobytes())
+        if key == self.last_key:
+            self.reused += 1
+            return self.last_output
+        # 映射失败时不能留下上一帧的键，否则下一帧可能复用错误的结果
+        self.last_key = None
+        rgb_frame = frame.convert('RGB')
+        reduced_frame = remap_to_palette(rgb_frame, self.palette_image, mask)
+        if palette_distortion(rgb_frame, reduced_frame, mask) > PALETTE_MAX_DISTORTED:
+            self.local_frames += 1
+            reduced_frame = quantize_local(rgb_frame, mask)
+        self.last_output = reduced_frame
+        self.last_key = key
+        return self.last_output
+
+
+class FlattenQuantizer:
+    """
+    兜底的量化策略：铺在白色背景上后单独量化，只有完全透明（alpha=0）的像素标记为透明。
+    不依赖其他帧，用于替换某一帧上失败的策略。
+    """
+    sample_size = 0
+
+    def prepare(self, sample_frames: list):
+        pass
+
+    def quantize(self, frame: Image.Image) -> Image.Image:
+        alpha = frame.getchannel('A')
+        rgb_frame = Image.new('RGB', frame.size, (255, 255, 255))
+        rgb_frame.paste(frame, mask=alpha)
+        return quantize_local(rgb_frame, alpha.point(lambda p: 255 if p == 0 else 0))
+
+
+def create_quantizer(palette_mode: str, transparency_index=None):
+    """
+    palette_mode:
+    - "global": 整段动画共享一个调色板（默认）
+    - "adaptive": 每帧单独 ADAPTIVE 量化
+    - "none": 不量化，产出 RGBA 帧
+    """
+    if palette_mode == "global":
+        return GlobalPaletteQuantizer()
+    if palette_mode == "adaptive":
+        return AdaptiveQuantizer(transparency_index is not None)
+    if palette_mode == "none":
+        return TruecolorQuantizer()
+    raise ValueError(f"Invalid palette_mode: {palette_mode}")
+
+
+def iter_frames(image: Image.Image, start_frame: int = 0):
+    """
+    从 start_frame 开始逐帧 seek，与 ImageSequence.Iterator 不同，可以从中途接着处理而不必回到第一帧
+    """
+    frame_index = start_frame
+    while True:
+        try:
+            image.seek(frame_index)
+        except EOFError:
+            return
+        yield image
+        frame_index += 1
+
+
+def collect_frames(frame_items) -> tuple:
+    """
+    把逐帧产出的 (frame, duration, disposal_method) 收集为 frames, durations, disposal_methods 三个列表
     """
     frames = []
     durations = []
     disposal_methods = []
+    for frame, duration, disposal_method in frame_items:
+        frames.append(frame)
+        durations.append(duration)
+        disposal_methods.append(disposal_method)
+    return frames, durations, disposal_methods
 
-    width, height = image.size
-    crop_width = int(width * horizontal_crop_percent / 100)
-    crop_height = int(height * vertical_crop_percent / 100)
 
-    # 检查透明索引（如果存在）
+def can_process_indexed(image: Image.Image) -> bool:
+    return image.format == 'GIF' and image.mode == 'P'
+
+
+def iter_rgba_frames(image: Image.Image, start_frame: int = 0, keep_indexed: bool = False):
+    """
+    逐帧解码，产出 (frame, duration, disposal_method)。Pillow 解码时已经按 disposal 和透明度把每一帧合成为完整画布，
+    产出的就是当前应显示的画面。帧一般转换为 RGBA；keep_indexed 时，与第一帧共用调色板和透明索引的 GIF 帧保持 P 模式，
+    由 FrameCompositor 直接在索引数据上镜像，保留源调色板，不需要 RGBA 往返和量化。
+    出现不同的调色板后，Pillow 之后的帧都会解码为 RGB(A)。
+    产出的帧是独立的副本，可以用 itertools.tee 分发给多个处理流程。
+    """
+    palette = image.getpalette() if keep_indexed and can_process_indexed(image) else None
     transparency_index = image.info.get('transparency', None)
+    for frame_index, frame in enumerate(iter_frames(image, start_frame), start_frame):
+        # 获取当前帧的 duration 和 disposal_method
+        duration = frame.info.get('duration', 100)
+        disposal_method = getattr(frame, 'disposal_method', 2)
+        start = time.perf_counter()
+        frame.load()
+        record_stage("decode", start)
+        if palette is not None:
+            if (frame.mode == 'P' and frame.getpalette() == palette
+                    and frame.info.get('transparency', None) == transparency_index):
+                yield frame.copy(), duration, disposal_method
+                continue
+            logger.debug("第 %s 帧的调色板与全局调色板不同，之后的帧改为转换成 RGBA 处理", frame_index)
+            palette = None
+        # 转换为 RGBA 模式，确保透明处理
+        start = time.perf_counter()
+        current = frame.convert('RGBA')
+        record_stage("convert", start)
+        yield current, duration, disposal_method
+
+
+class FrameCompositor:
+    """
+    动画的逐帧处理引擎：每帧只镜像一次、量化一次，GIF、WebP、APNG 输出和批量处理都使用它。
 
-    try:
-        previous_frame = None
-        for frame in ImageSequence.Iterator(image):
-            # 获取当前帧的 duration 和 disposal_method
-            durations.append(frame.info.get('duration', 100))
-            disposal_method = getattr(frame, 'disposal_method', 2)
-            disposal_methods.append(disposal_method)
-
-            # 转换为 RGBA 模式，确保透明处理
-            current = frame.convert('RGBA')
-
-            # 创建新的透明画布
-            if selected_side == "left" or selected_side == "right":
-                new_frame = Image.new('RGBA', (crop_width * 2, height), (0, 0, 0, 0))
-                new_frame = crop_mirror_image(current, new_frame, crop_width, crop_height, width, height, selected_side)
-
-            elif selected_side == "up" or selected_side == "down":
-                new_frame = Image.new('RGBA', (width, crop_height * 2), (0, 0, 0, 0))
-                new_frame = crop_mirror_image(current, new_frame, crop_width, crop_height, width, height, selected_side)
-
-            elif selected_side == "q1":
-                new_canvas = Image.new('RGBA', (crop_width * 2, height), (0, 0, 0, 0))
-                new_frame = crop_mirror_image(current, new_canvas, crop_width, crop_height, width, height, "left")
-                new_canvas = Image.new('RGBA', (crop_width * 2, crop_height * 2), (0, 0, 0, 0))
-                new_frame = crop_mirror_image(new_frame, new_canvas, crop_width, crop_height, crop_width * 2, height, "up")
-
-            elif selected_side == "q2":
-                new_frame = Image.new('RGBA', (crop_width * 2, height), (0, 0, 0, 0))
-                new_frame = crop_mirror_image(current, new_frame, crop_width, crop_height, width, height, "right")
-                new_canvas = Image.new('RGBA', (crop_width * 2, crop_height * 2), (0, 0, 0, 0))
-                new_frame = crop_mirror_image(new_frame, new_canvas, crop_width, crop_height, crop_width * 2, height, "up")
-
-            elif selected_side == "q3":
-                new_canvas = Image.new('RGBA', (crop_width * 2, height), (0, 0, 0, 0))
-                new_frame = crop_mirror_image(current, new_canvas, crop_width, crop_height, width, height, "right")
-                new_canvas = Image.new('RGBA', (crop_width * 2, crop_height * 2), (0, 0, 0, 0))
-                new_frame = crop_mirror_image(new_frame, new_canvas, crop_width, crop_height, crop_width * 2, height, "down")
-
-            elif selected_side == "q4":
-                new_canvas = Image.new('RGBA', (crop_width * 2, height), (0, 0, 0, 0))
-                new_frame = crop_mirror_image(current, new_canvas, crop_width, crop_height, width, height, "left")
-                width, height = new_frame.size
-                new_canvas = Image.new('RGBA', (crop_width * 2, crop_height * 2), (0, 0, 0, 0))
-                new_frame = crop_mirror_image(new_frame, new_canvas, crop_width, crop_height, crop_width * 2, height, "down")
-            else:
-                raise ValueError(f"Invalid selected_side: {selected_side}")
-
-            # 根据 disposal_method 处理残影
-            if disposal_method == 0 or disposal_method == 1:
-                if previous_frame:
-                    new_frame = Image.alpha_composite(previous_frame, new_frame)
-            elif disposal_method == 2:
-                pass  # 恢复到背景（透明）
-            elif disposal_method == 3 and previous_frame:
-                new_frame = Image.alpha_composite(previous_frame, new_frame)
-
-            # 转换为调色板模式
-            reduced_frame = new_frame.convert('P', palette=Image.ADAPTIVE, colors=255)
-
-            # 如果存在透明索引，则添加到调色板
-            if transparency_index is not None:
-                palette = reduced_frame.getpalette()
-                transparent_color = (0, 0, 0)  # 假定透明色为黑色
-                transparent_index = len(palette) // 3
-                if transparent_index < 256:
-                    palette[transparent_index * 3:transparent_index * 3 + 3] = transparent_color
-                    reduced_frame.putpalette(palette)
-
-                    # 应用透明掩码
-                    mask = new_frame.split()[-1].point(lambda p: 255 if p < 128 else 0)
-                    reduced_frame.paste(transparent_index, mask=mask)
-                    reduced_frame.info['transparency'] = transparent_index
-
-            frames.append(reduced_frame)
-            previous_frame = new_frame
-
-    except EOFError:
-        pass  # 到达最后一帧
+    输入帧是解码器合成好的完整画布（见 iter_rgba_frames），这里不再叠加上一帧：按当前帧的 disposal
+    叠加上一帧的输出会让 disposal 2/3 的帧留下残影。输出的每一帧也是完整画布，写出时的 disposal 由编码器决定（见 encode_gif_stream）。
 
-    return frames, durations, disposal_methods
+    P 模式的帧直接在索引数据上镜像并原样产出；RGBA 帧交给 quantizer 量化（见 create_quantizer）。
+    quantizer 需要抽样时，先缓冲 sample_size 帧调用 prepare，之后逐帧 quantize。
+    某一帧量化失败时只有这一帧改用 fallback，已处理的帧不会重做；prepare 失败时之后的帧都改用 fallback。
+    fallback 为 None 时直接抛出异常。
+    """
+    def __init__(self, size: tuple, horizontal_crop_percent: int, vertical_crop_percent: int, selected_side: str,
+                 quantizer, fallback=None):
+        self.width, self.height = size
+        self.crop_width, self.crop_height = crop_size(self.width, self.height, horizontal_crop_percent,
+                                                      vertical_crop_percent)
+        self.selected_side = selected_side
+        if selected_side == "left" or selected_side == "right":
+            self.canvas_size = (self.crop_width * 2, self.height)
+        elif selected_side == "up" or selected_side == "down":
+            self.canvas_size = (self.width, self.crop_height * 2)
+        elif selected_side in ("q1", "q2", "q3", "q4"):
+            self.canvas_size = (self.crop_width * 2, self.crop_height * 2)
+        else:
+            raise ValueError(f"Invalid selected_side: {selected_side}")
+        self.quantizer = quantizer
+        self.fallback = fallback
+        self.prepared = quantizer.sample_size == 0
+        self.fallback_frames = 0
+
+    def mirror(self, frame: Image.Image) -> Image.Image:
+        if frame.mode == 'P':
+            transparency_index = frame.info.get('transparency', None)
+            canvas = Image.new('P', self.canvas_size, transparency_index if transparency_index is not None else 0)
+            canvas.putpalette(frame.getpalette())
+        else:
+            canvas = Image.new('RGBA', self.canvas_size, (0, 0, 0, 0))
+        if self.selected_side in ("q1", "q2", "q3", "q4"):
+            canvas = quadrant_mirror_image(frame, canvas, self.crop_width, self.crop_height, self.width, self.height,
+                                           self.selected_side)
+        else:
+            canvas = crop_mirror_image(frame, canvas, self.crop_width, self.crop_height, self.width, self.height,
+                                       self.selected_side)
+        if frame.mode == 'P' and transparency_index is not None:
+            canvas.info['transparency'] = transparency_index
+        return canvas
+
+    def prepare(self, sample_frames: list):
+        self.prepared = True
+        try:
+            self.quantizer.prepare(sample_frames)
+        except Exception as e:
+            if self.fallback is None:
+                raise
+            logger.warning("Quantizer preparation failed, using fallback for the remaining frames: %s", e)
+            self.quantizer = self.fallback
+
+    def quantize(self, frame_index: int, frame: Image.Image) -> Image.Image:
+        if frame.mode == 'P':
+            return frame
+        try:
+            return self.quantizer.quantize(frame)
+        except Exception as e:
+            if self.fallback is None:
+                raise
+            logger.warning("Quantization failed at frame %s, using fallback: %s", frame_index, e)
+            self.fallback_frames += 1
+            return self.fallback.quantize(frame)
+
+    def drain(self, pending: list):
+        start = time.perf_counter()
+        if not self.prepared:
+            sample_frames = [frame for _, frame, _, _ in pending if frame.mode != 'P']
+            if sample_frames:
+                self.prepare(sample_frames)
+        ready = [(self.quantize(frame_index, frame), duration, disposal_method)
+                 for frame_index, frame, duration, disposal_method in pending]
+        pending.clear()
+        record_stage("quantize", start)
+        return ready
+
+    def process(self, frame_items):
+        """
+        产出 (frame, duration, disposal_method)。只有等待抽样时才缓冲，缓冲的帧数不超过 sample_size 加上之前的 P 帧。
+        """
+        pending = []
+        samples = 0
+        for frame_index, (frame, duration, disposal_method) in enumerate(frame_items):
+            start = time.perf_counter()
+            canvas = self.mirror(frame)
+            record_stage("mirror", start)
+            pending.append((frame_index, canvas, duration, disposal_method))
+            if canvas.mode != 'P':
+                samples += 1
+            if self.prepared or samples == 0 or samples >= self.quantizer.sample_size:
+                yield from self.drain(pending)
+        yield from self.drain(pending)
+
+
+def mirror_rgba_frames(frame_items, size: tuple, horizontal_crop_percent: int, vertical_crop_percent: int,
+                       selected_side: str, palette_mode: str = "global", transparency_index=None):
+    """
+    对已解码的帧（见 iter_rgba_frames）做镜像和量化，产出 (frame, duration, disposal_method)。
+    palette_mode 见 create_quantizer；量化失败的帧改用 FlattenQuantizer。
+    """
+    quantizer = create_quantizer(palette_mode, transparency_index)
+    fallback = FlattenQuantizer() if palette_mode != "none" else None
+    compositor = FrameCompositor(size, horizontal_crop_percent, vertical_crop_percent, selected_side, quantizer,
+                                 fallback)
+    return compositor.process(frame_items)
 
 
-def process_animated_image_combined(image: Image.Image, horizontal_crop_percent: int, vertical_crop_percent: int, selected_side: str) -> tuple:
-    try:
-        frames, durations, disposal_methods = process_animated_image(image, horizontal_crop_percent, vertical_crop_percent, selected_side)
+def iter_animated_image(image: Image.Image, horizontal_crop_percent: int, vertical_crop_percent: int, selected_side: str,
+                        palette_mode: str = "global", keep_indexed: bool = True):
+    """
+    逐帧解码、镜像、量化整段动画，产出 (frame, duration, disposal_method)。
+    keep_indexed 时 GIF 的帧尽量保持调色板模式（见 iter_rgba_frames），palette_mode 为 "none" 时不使用。
+    """
+    keep_indexed = keep_indexed and palette_mode != "none"
+    return mirror_rgba_frames(iter_rgba_frames(image, keep_indexed=keep_indexed), image.size, horizontal_crop_percent,
+                              vertical_crop_percent, selected_side, palette_mode, image.info.get('transparency', None))
 
-    except Exception as e:
-        frames, durations, disposal_methods = process_animated_image_spare(image, horizontal_crop_percent, vertical_crop_percent, selected_side)
 
-    return frames, durations, disposal_methods
+def process_animated_image(image: Image.Image, horizontal_crop_percent: int, vertical_crop_percent: int, selected_side: str,
+                           palette_mode: str = "global", keep_indexed: bool = True) -> tuple:
+    return collect_frames(iter_animated_image(image, horizontal_crop_percent, vertical_crop_percent, selected_side,
+                                              palette_mode, keep_indexed))
+
+
+def index_plane(frame: Image.Image) -> Image.Image:
+    # P 帧的原始索引数据，作为 L 图像参与逐像素比较
+    return Image.frombytes('L', frame.size, frame.tobytes())
+
+
+def transparent_plane(frame: Image.Image):
+    """
+    透明像素为 255、其余为 0 的 L 图像；帧没有透明索引时返回 None
+    """
+    transparency = frame.info.get('transparency', None)
+    if not isinstance(transparency, int):
+        return None
+    return index_plane(frame).point(lambda i: 255 if i == transparency else 0)
+
+
+def needs_clear(previous: tuple, current: tuple) -> bool:
+    """
+    current 中有透明像素覆盖在 previous 的不透明像素上时，保留上一帧（disposal 1）会留下残影，
+    必须在 previous 之后清空画布（disposal 2）。
+    """
+    current_transparent = current[2]
+    if current_transparent is None:
+        return False
+    previous_transparent = previous[2]
+    if previous_transparent is None:
+        return current_transparent.getbbox() is not None
+    previous_opaque = ImageChops.invert(previous_transparent)
+    return ImageChops.multiply(previous_opaque, current_transparent).getbbox() is not None
+
+
+def same_palette(previous: tuple, current: tuple) -> bool:
+    return (previous[0].getpalette() == current[0].getpalette()
+            and previous[0].info.get('transparency', None) == current[0].info.get('transparency', None))
+
+
+def encode_gif_stream(frame_items, loop: int = 0, disposal: int = 2, optimize: bool = True):
+    """
+    逐帧编码 GIF 并产出字节块，不像 Image.save(append_images=...) 那样先把所有帧收集起来。
+    与全局调色板不同的帧会写入局部调色板。
+
+    optimize 时：
+    - 与上一帧完全相同的帧不再写出，时长合并到上一帧（产出空块）
+    - 与上一帧共用调色板的帧只写出变化区域的外接矩形，矩形内未变化的像素写成透明色，压缩率更高
+    - 只有下一帧需要清空画布时才对当前帧使用 disposal 2（此时当前帧写出完整画布），其余帧使用 disposal 1
+    为了决定 disposal，编码会比输入晚一帧。
+    """
+    global_palette = None
+    first = None
+    previous = None
+    current = None
+
+    def write(item: tuple, next_item: tuple):
+        frame, duration, transparent = item
+        params = {'duration': duration, 'include_color_table': frame.getpalette() != global_palette}
+        if 'transparency' in frame.info:
+            params['transparency'] = frame.info['transparency']
+        if not optimize:
+            params['disposal'] = disposal
+            return b"".join(GifImagePlugin.getdata(frame, **params))
+
+        clear_after = needs_clear(item, next_item)
+        params['disposal'] = 2 if clear_after else 1
+        if previous is None or clear_after or not same_palette(previous, item) or needs_clear(previous, item):
+            return b"".join(GifImagePlugin.getdata(frame, **params))
+
+        difference = ImageChops.difference(index_plane(previous[0]), index_plane(frame))
+        box = difference.getbbox()
+        patch = frame.crop(box)
+        if transparent is not None:
+            unchanged = difference.crop(box).point(lambda d: 255 if d == 0 else 0)
+            patch.paste(frame.info['transparency'], mask=unchanged)
+        return b"".join(GifImagePlugin.getdata(patch, offset=box[:2], **params))
+
+    for frame, duration, _ in frame_items:
+        if global_palette is None:
+            header, _ = GifImagePlugin.getheader(frame, info={'loop': loop, 'duration': duration})
+            global_palette = frame.getpalette()
+            yield b"".join(header)
+
+        item = [frame, duration, transparent_plane(frame) if optimize else None]
+        if current is None:
+            first = current = item
+            continue
+        if optimize and (frame is current[0] or (
+                same_palette(current, item)
+                and ImageChops.difference(index_plane(current[0]), index_plane(frame)).getbbox() is None)):
+            current[1] += duration
+            # 每消费一个输入帧都产出一次（空块），按帧轮流推进多个编码器时 tee 不会缓存整段动画
+            yield b""
+            continue
+        start = time.perf_counter()
+        data = write(current, item)
+        record_stage("encode", start)
+        yield data
+        previous, current = current, item
+
+    if current is not None:
+        # 循环播放时最后一帧之后是第一帧
+        start = time.perf_counter()
+        data = write(current, first)
+        record_stage("encode", start)
+        yield data
+        yield b";"  # GIF 结束标记
 
 ###################
 
 
-def process_image_locally(file_path, horizontal_crop_percent, vertical_crop_percent, selected_side, output_dir):
+def encode_animation(frame_items, output_format: str, loop: int = 0, **options) -> bytes:
+    """
+    把真彩色 RGBA 帧编码为动画 WebP 或 APNG，不经过调色板量化。
+    每一帧都是完整画布，编码器自行计算帧间差异；两种编码器都要拿到全部帧才能写出文件，不能逐帧流式输出。
+    options 会传给 Pillow 的保存参数，例如 WebP 的 quality、method、lossless。
+    """
+    frames, durations, _ = collect_frames(frame_items)
+    start = time.perf_counter()
+    buffer = io.BytesIO()
+    if output_format == "webp":
+        frames[0].save(buffer, format="WEBP", save_all=True, append_images=frames[1:], duration=durations,
+                       loop=loop, **options)
+    elif output_format == "png":
+        frames[0].save(buffer, format="PNG", save_all=True, append_images=frames[1:], duration=durations,
+                       loop=loop, **options)
+    else:
+        raise ValueError(f"Invalid output_format: {output_format}")
+    record_stage("encode", start)
+    return buffer.getvalue()
+
+
+def process_image_locally(file_path, horizontal_crop_percent, vertical_crop_percent, selected_side, output_dir,
+                          output_name=None):
     """
     本地处理图像，支持静态和动态（GIF）图像。
 
@@ -342,6 +938,7 @@ def process_image_locally(file_path, horizontal_crop_percent, vertical_crop_perc
     - crop_percent (int): 裁剪百分比。
     - selected_side (str): 裁剪的边，'left' 或 'right'。
     - output_dir (str): 输出目录。
+    - output_name (str): 相对于输出目录的文件名，默认按裁剪参数和源文件名生成。
 
     返回：
     - str: 输出文件路径。
@@ -353,62 +950,227 @@ def process_image_locally(file_path, horizontal_crop_percent, vertical_crop_perc
         vertical_crop_percent = 100 - vertical_crop_percent
 
     try:
-        original_filename = file_path[file_path.rfind('\\') + 1:]
-        print(f"Processing {original_filename}")
-        output_path = os.path.join(output_dir, f"{selected_side}_{horizontal_crop_percent}_{original_filename}")
+        original_filename = os.path.basename(file_path)
+        logger.info("Processing %s", original_filename)
+        output_path = os.path.join(output_dir,
+                                   output_name or f"{selected_side}_{horizontal_crop_percent}_{original_filename}")
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
 
         # 打开图像
         with open(file_path, "rb") as f:
             content = f.read()
         image = Image.open(io.BytesIO(content))
         is_animated = getattr(image, "is_animated", False)
-        print(f"Processing image. Is animated: {is_animated}")
+        logger.debug("Processing image. Is animated: %s", is_animated)
 
         if is_animated:
-            # 处理 GIF 动画
-            frames, durations, _ = process_animated_image_combined(image, horizontal_crop_percent, vertical_crop_percent,  selected_side)
-            try:
-                frames[0].save(
-                    output_path,
-                    save_all=True,
-                    append_images=frames[1:],
-                    duration=durations,
-                    disposal=2,
-                    loop=0
-                )
-            except Exception as e:
-                frames[0].save(
-                    output_path,
-                    save_all=True,
-                    append_images=frames[1:],
-                    duration=durations,
-                    disposal=1,
-                    loop=0
-                )
+            # 逐帧处理并编码，输出格式与扩展名一致：GIF 流式写出，WebP/APNG 保持真彩色
+            output_format = os.path.splitext(output_path)[1].lower().lstrip('.')
+            if output_format == "gif":
+                with open(output_path, "wb") as f:
+                    for chunk in encode_gif_stream(iter_animated_image(image, horizontal_crop_percent,
+                                                                       vertical_crop_percent, selected_side)):
+                        f.write(chunk)
+            else:
+                data = encode_animation(iter_animated_image(image, horizontal_crop_percent, vertical_crop_percent,
+                                                            selected_side, palette_mode="none"), output_format)
+                with open(output_path, "wb") as f:
+                    f.write(data)
 
         else:
-            # 处理静态图像
-            image = correct_image_orientation(image)
-            result = process_static_image(image, horizontal_crop_percent, vertical_crop_percent, selected_side)
+            # 处理静态图像，只解码用到的区域，并按 EXIF orientation 转正
+            result = process_static_image_region(image, horizontal_crop_percent, vertical_crop_percent, selected_side)
             # 确保 JPEG 兼容性
             if file_path.lower().endswith(('.jpg', '.jpeg')) and result.mode != "RGB":
                 result = result.convert("RGB")
             result.save(output_path)
 
-        print(f"Image processed successfully. Saved to {output_path}")
+        logger.info("Image processed successfully. Saved to %s", output_path)
         return output_path
     except Exception as e:
-        print(f"Error processing image: {e}")
+        logger.error("Error processing image: %s", e)
         raise
 
 
-if __name__ == '__main__':
-    file_path = os.path.join("examples", "test", "IMG_0501.gif")
-    output_dir = os.path.join("examples", "test", "output")
+# 批量处理时识别的图像扩展名
+SUPPORTED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+# 记录每个输出对应的源文件状态和参数，用于跳过已是最新的输出
+MANIFEST_FILENAME = ".mirror_manifest.json"
 
-    horizontal_crop_percent = 60
-    vertical_crop_percent = 40
 
-    selected_side = "q1"
-    file_path = process_image_locally(file_path, horizontal_crop_percent, vertical_crop_percent, selected_side, output_dir)
+def glob_root(pattern: str) -> str:
+    """
+    通配符中第一个含通配字符的路径段之前的部分，例如 'assets/**/*.gif' 的根为 'assets'
+    """
+    root = []
+    for part in pattern.replace(os.sep, "/").split("/"):
+        if glob.has_magic(part):
+            break
+        root.append(part)
+    return "/".join(root)
+
+
+def expand_inputs(inputs: list) -> dict:
+    """
+    把目录、通配符和文件路径展开为去重后的图像文件，返回 {文件路径: 相对路径}。
+    目录只取第一层的图像文件，相对路径相对于该目录；通配符的相对路径相对于通配符之前的目录，
+    以便输出时保留子目录结构；单独指定的文件只保留文件名。
+    """
+    paths = {}
+    for item in inputs:
+        if os.path.isdir(item):
+            root = item
+            matches = [os.path.join(item, name) for name in sorted(os.listdir(item))]
+        elif glob.has_magic(item):
+            root = glob_root(item)
+            matches = sorted(glob.glob(item, recursive=True))
+        else:
+            root = os.path.dirname(item)
+            matches = [item]
+        for path in matches:
+            if os.path.isfile(path) and path.lower().endswith(SUPPORTED_EXTENSIONS):
+                paths.setdefault(path, os.path.relpath(path, root or "."))
+    return paths
 
+
+def output_filename(relative_path: str, horizontal_crop_percent: int, selected_side: str) -> str:
+    # 与 process_image_locally 的命名一致，比例为调整后的值；保留相对路径中的子目录
+    if selected_side == "right" or selected_side == "q2" or selected_side == "q3":
+        horizontal_crop_percent = 100 - horizontal_crop_percent
+    directory, name = os.path.split(relative_path)
+    return os.path.join(directory, f"{selected_side}_{horizontal_crop_percent}_{name}").replace(os.sep, "/")
+
+
+def file_digest(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def is_up_to_date(file_path: str, output_path: str, params: list, entry) -> bool:
+    """
+    输出已存在且参数一致时，源文件的大小和修改时间与记录相同即为最新；
+    修改时间变化但内容哈希相同（例如重新拷贝）也视为最新。
+    """
+    if entry is None or entry.get("params") != params or not os.path.exists(output_path):
+        return False
+    stat = os.stat(file_path)
+    if entry.get("size") == stat.st_size and entry.get("mtime_ns") == stat.st_mtime_ns:
+        return True
+    return entry.get("size") == stat.st_size and entry.get("digest") == file_digest(file_path)
+
+
+def process_file_task(file_path: str, horizontal_crop_percent: int, vertical_crop_percent: int, selected_side: str,
+                      output_dir: str, output_name: str = None) -> tuple:
+    """
+    在进程池中处理单个文件，返回 (输出路径, 耗时, 源文件大小, 源文件哈希)
+    """
+    start = time.perf_counter()
+    output_path = process_image_locally(file_path, horizontal_crop_percent, vertical_crop_percent, selected_side,
+                                        output_dir, output_name)
+    return output_path, time.perf_counter() - start, os.path.getsize(file_path), file_digest(file_path)
+
+
+def process_directory(inputs: list, horizontal_crop_percent: int, vertical_crop_percent: int, selected_side: str,
+                      output_dir: str, workers: int = None, force: bool = False) -> dict:
+    """
+    批量处理目录、通配符或文件列表，文件分配到进程池中并行处理。
+    已是最新的输出会被跳过（force=True 时全部重新处理），结束后打印吞吐量统计。
+
+    返回：
+    - dict: 处理、跳过、失败的文件数和耗时统计。
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+
+    params = [selected_side, horizontal_crop_percent, vertical_crop_percent]
+    paths = expand_inputs(inputs)
+    # 输出名 -> 源文件。多个输入映射到同一个输出时只处理第一个，其余的记为失败，避免互相覆盖
+    outputs = {}
+    failed = 0
+    for file_path, relative_path in paths.items():
+        name = output_filename(relative_path, horizontal_crop_percent, selected_side)
+        if name in outputs:
+            failed += 1
+            logger.error("处理失败 %s: 与 %s 的输出文件名相同: %s", file_path, outputs[name], name)
+            continue
+        outputs[name] = file_path
+
+    pending = []
+    skipped = 0
+    for name, file_path in outputs.items():
+        if not force and is_up_to_date(file_path, os.path.join(output_dir, name), params, manifest.get(name)):
+            skipped += 1
+        else:
+            pending.append((name, file_path))
+
+    logger.info("共 %s 个文件，跳过已是最新的 %s 个，待处理 %s 个，输出文件名冲突 %s 个", len(paths), skipped,
+                len(pending), failed)
+    processed = 0
+    total_bytes = 0
+    worker_seconds = 0.0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_file_task, file_path, horizontal_crop_percent, vertical_crop_percent,
+                                   selected_side, output_dir, name): (name, file_path)
+                   for name, file_path in pending}
+        for future in as_completed(futures):
+            name, file_path = futures[future]
+            try:
+                _, elapsed, size, digest = future.result()
+            except Exception as e:
+                failed += 1
+                logger.error("处理失败 %s: %s", file_path, e)
+                continue
+            stat = os.stat(file_path)
+            manifest[name] = {
+                "params": params, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "digest": digest,
+            }
+            processed += 1
+            total_bytes += size
+            worker_seconds += elapsed
+    wall_seconds = time.perf_counter() - start
+
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    stats = {
+        "total": len(paths),
+        "processed": processed,
+        "skipped": skipped,
+        "failed": failed,
+        "wall_seconds": wall_seconds,
+        "worker_seconds": worker_seconds,
+        "files_per_second": processed / wall_seconds if wall_seconds > 0 else 0.0,
+        "mb_per_second": total_bytes / 1024 / 1024 / wall_seconds if wall_seconds > 0 else 0.0,
+    }
+    logger.info("处理 %s 个，跳过 %s 个，失败 %s 个，耗时 %.2fs，%.2f 文件/s，%.2f MB/s，并行度 %.2f",
+                processed, skipped, failed, wall_seconds, stats["files_per_second"], stats["mb_per_second"],
+                worker_seconds / wall_seconds if wall_seconds > 0 else 0.0)
+    return stats
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="批量生成镜像图像")
+    parser.add_argument("inputs", nargs="*", default=[os.path.join("examples", "test", "IMG_0501.gif")],
+                        help="输入文件、目录或通配符（如 'assets/**/*.gif'，输出保留通配符之后的子目录）")
+    parser.add_argument("-o", "--output-dir", default=os.path.join("examples", "test", "output"))
+    parser.add_argument("-s", "--side", default="q1", choices=["left", "right", "up", "down", "q1", "q2", "q3", "q4"])
+    parser.add_argument("--horizontal", type=int, default=60, help="水平裁剪比例")
+    parser.add_argument("--vertical", type=int, default=40, help="垂直裁剪比例")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="进程数，默认为 CPU 核数")
+    parser.add_argument("-f", "--force", action="store_true", help="忽略已是最新的输出，全部重新处理")
+    parser.add_argument("-v", "--verbose", action="store_true", help="输出逐帧的调试日志")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format="%(message)s")
+    process_directory(args.inputs, args.horizontal, args.vertical, args.side, args.output_dir, args.workers, args.force)
@@ -0,0 +1,219 @@
+import asyncio
+import heapq
+import itertools
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Optional
+
+
+class Job:
+    """
+    一个异步处理任务，状态依次为 queued、running，最后为 done 或 failed。
+    所有字段都只在事件循环线程中修改；工作线程中的进度需要通过 loop.call_soon_threadsafe 回到事件循环。
+    """
+    def __init__(self, client_id: str, cost: float, frame_total: int, work: Optional[Callable] = None):
+        self.job_id = uuid.uuid4().hex
+        self.client_id = client_id
+        self.cost = cost
+        self.frame_total = frame_total
+        # work(job) 是执行任务的协程函数，返回值保存在 result 中
+        self.work = work
+        self.status = "queued"
+        self.frames_done = 0
+        self.submitted = time.monotonic()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error: Optional[Exception] = None
+        self.sort_key = None
+        self.changed = asyncio.Event()
+        # 每次状态变化后调用 observer(job)，用于把状态同步给其他 worker
+        self.observer: Optional[Callable] = None
+
+    def notify(self):
+        # 唤醒所有等待中的订阅者，之后的订阅者等待新的 Event
+        self.changed.set()
+        self.changed = asyncio.Event()
+        if self.observer is not None:
+            self.observer(self)
+
+    def set_progress(self, frames_done: int):
+        if self.status == "running" and frames_done > self.frames_done:
+            self.frames_done = frames_done
+            self.notify()
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "frames_done": self.frames_done,
+            "frame_total": self.frame_total,
+            "progress": self.frames_done / self.frame_total if self.frame_total else 0.0,
+            "cost": self.cost,
+            "queued_seconds": (self.started or self.finished or now) - self.submitted,
+            "running_seconds": (self.finished or now) - self.started if self.started else 0.0,
+        }
+
+
+class JobScheduler:
+    """
+    最短任务优先（SJF）的任务调度器：预估开销小的任务先执行，大任务不会挡住小任务。
+    为了避免大任务一直等待，等待时间会抵扣开销：有效开销 = cost - aging_rate × 已等待秒数。
+    所有任务的等待时间同速增长，排序等价于按 cost + aging_rate × 提交时间，堆中的键不需要随时间更新。
+    同一客户端同时执行的任务数不超过 max_running_per_client，超出时跳过该客户端的任务，先执行其他客户端的。
+    """
+    def __init__(self, workers: int, max_running_per_client: int, aging_rate: float, result_ttl_seconds: float,
+                 max_finished: int):
+        self.workers = workers
+        self.max_running_per_client = max_running_per_client
+        self.aging_rate = aging_rate
+        self.result_ttl_seconds = result_ttl_seconds
+        self.max_finished = max_finished
+        # (sort_key, job)，sort_key 中的序号保证开销相同时按提交顺序执行
+        self.heap = []
+        self.sequence = itertools.count()
+        self.jobs = {}
+        # 已完成任务的 job_id，按完成时间排列，最早完成的在最前面
+        self.finished_jobs: "OrderedDict[str, None]" = OrderedDict()
+        self.running_by_client = {}
+        self.unfinished_by_client = {}
+        self.available = asyncio.Event()
+        self.tasks = []
+        self.draining = False
+
+    def start(self):
+        if not self.tasks:
+            # Event 绑定到首次使用它的事件循环，每次启动时重新创建
+            self.available = asyncio.Event()
+            self.draining = False
+            self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def drain(self, timeout: float):
+        """
+        停止接收新任务，等待排队和执行中的任务完成，最多等待 timeout 秒
+        """
+        self.draining = True
+        deadline = time.monotonic() + timeout
+        while (self.heap or self.running_by_client) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+    async def shutdown(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    @property
+    def queued(self) -> int:
+        return len(self.heap)
+
+    def client_unfinished(self, client_id: str) -> int:
+        return self.unfinished_by_client.get(client_id, 0)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def submit(self, job: Job) -> Job:
+        job.sort_key = (job.cost + self.aging_rate * job.submitted, next(self.sequence))
+        heapq.heappush(self.heap, (job.sort_key, job))
+        self.jobs[job.job_id] = job
+        self.unfinished_by_client[job.client_id] = self.client_unfinished(job.client_id) + 1
+        self.available.set()
+        return job
+
+    def add_finished(self, job: Job, result) -> Job:
+        # 不需要排队的任务（例如结果缓存命中）直接记为完成
+        job.status = "done"
+        job.frames_done = job.frame_total
+        job.result = result
+        job.started = job.finished = time.monotonic()
+        self.jobs[job.job_id] = job
+        self.finished_jobs[job.job_id] = None
+        job.notify()
+        self.purge()
+        return job
+
+    def queue_position(self, job: Job) -> int:
+        """
+        排在该任务之前的排队任务数。之后提交的小任务仍可能插到前面，只作参考。
+        """
+        if job.status != "queued":
+            return 0
+        return sum(1 for sort_key, _ in self.heap if sort_key < job.sort_key)
+
+    def next_job(self) -> Optional[Job]:
+        skipped = []
+        job = None
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            if self.running_by_client.get(entry[1].client_id, 0) < self.max_running_per_client:
+                job = entry[1]
+                break
+            skipped.append(entry)
+        for entry in skipped:
+            heapq.heappush(self.heap, entry)
+        return job
+
+    async def worker(self):
+        while True:
+            job = self.next_job()
+            if job is None:
+                # 检查和等待之间没有 await，不会丢失 submit 的唤醒
+                self.available.clear()
+                await self.available.wait()
+                continue
+            await self.execute(job)
+
+    async def execute(self, job: Job):
+        client_id = job.client_id
+        self.running_by_client[client_id] = self.running_by_client.get(client_id, 0) + 1
+        job.status = "running"
+        job.started = time.monotonic()
+        job.notify()
+        try:
+            job.result = await job.work(job)
+            job.status = "done"
+            job.frames_done = job.frame_total
+        except asyncio.CancelledError:
+            job.status = "failed"
+            job.error = RuntimeError("服务器正在关闭，任务已取消")
+            raise
+        except Exception as e:
+            job.status = "failed"
+            job.error = e
+        finally:
+            job.finished = time.monotonic()
+            job.work = None
+            self.running_by_client[client_id] -= 1
+            if not self.running_by_client[client_id]:
+                del self.running_by_client[client_id]
+            self.unfinished_by_client[client_id] -= 1
+            if not self.unfinished_by_client[client_id]:
+                del self.unfinished_by_client[client_id]
+            self.finished_jobs[job.job_id] = None
+            job.notify()
+            # 该客户端的并发名额释放后，之前被跳过的任务可能可以执行了
+            self.available.set()
+            self.purge()
+
+    def purge(self):
+        """
+        删除过期的已完成任务；已完成任务超过 max_finished 时从最早完成的开始删除
+        """
+        expire_before = time.monotonic() - self.result_ttl_seconds
+        while self.finished_jobs:
+            job_id = next(iter(self.finished_jobs))
+            if self.jobs[job_id].finished >= expire_before and len(self.finished_jobs) <= self.max_finished:
+                break
+            del self.finished_jobs[job_id]
+            del self.jobs[job_id]
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queued,
+            "running": sum(self.running_by_client.values()),
+            "finished": len(self.finished_jobs),
+            "clients": len(self.unfinished_by_client),
+        }
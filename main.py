@@ -1,44 +1,77 @@
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse, Response, JSONResponse
 from contextlib import asynccontextmanager
-from image_process import process_animated_image_combined, process_static_image
+import image_process
+from image_process import (iter_animated_image, encode_gif_stream, process_static_image, build_preview_proxy,
+                           load_image_scaled, iter_rgba_frames, mirror_rgba_frames, encode_animation, record_stage,
+                           process_static_image_region, load_image_region, union_region, exif_orientation,
+                           correct_image_orientation, source_region_oriented, mirror_oriented_region)
+from cache import ResultCache, SourceCache, CachedSource, content_digest, make_cache_key
+from rate_limit import RateLimiter, MemoryRateLimitBackend, SqliteRateLimitBackend
+from metrics import MetricsRegistry, SIZE_BUCKETS
+from jobs import Job, JobScheduler
+from shared_state import MemoryFileRegistry, SqliteFileRegistry, SqliteJobStore, SqliteSourceStore
 import io
+import itertools
+import json
+import logging
+import math
 import os
 import time
 import uuid
+import warnings
+import zipfile
 import shutil
 from typing import Optional, Dict
-from datetime import datetime, timedelta
 import asyncio
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from PIL import Image, ExifTags
 
 # Lifespan 上下文管理器
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    print("Starting up...")
+    logger.info("Starting up...")
     cleanup_task = None
     try:
         if not os.path.exists(TEMP_DIR):
             os.makedirs(TEMP_DIR)
 
+        processing_pool.start()
+        job_scheduler.start()
+
         async def periodic_cleanup():
             while True:
-                file_manager.clean_expired_files()
-                await asyncio.sleep(FILE_EXPIRY_MINUTES * 60)
+                await file_manager.clean_expired_files()
+                job_scheduler.purge()
+                if job_store is not None:
+                    await asyncio.to_thread(job_store.prune, time.time() - JOB_RESULT_TTL_SECONDS)
+                if source_store is not None:
+                    await asyncio.to_thread(source_store.prune, time.time() - SOURCE_EXPIRY_MINUTES * 60)
+                if SERVER_WORKERS > 1:
+                    # 收录其他 worker 写入的结果，并按整个缓存目录的大小淘汰
+                    await asyncio.to_thread(result_cache.rescan_disk)
+                await asyncio.sleep(CLEANUP_INTERVAL_SECONDS)
 
         cleanup_task = asyncio.create_task(periodic_cleanup())
         yield
     finally:
-        print("Shutting down...")
+        logger.info("Shutting down...")
         if cleanup_task:
             cleanup_task.cancel()
             try:
                 await cleanup_task
             except asyncio.CancelledError:
                 pass
-        if os.path.exists(TEMP_DIR):
+        # 先完成已接收的任务，结果写入结果缓存（多个 worker 时还写入共享状态），再停止工作池
+        await job_scheduler.drain(JOB_DRAIN_SECONDS)
+        await job_scheduler.shutdown()
+        if job_state_writer is not None:
+            # 等待排队中的状态写入完成，其他 worker 才能查到最终结果
+            await asyncio.to_thread(job_state_writer.shutdown)
+        processing_pool.shutdown()
+        # 多个 worker 共用临时目录，由 server.py 在所有 worker 退出后删除
+        if SERVER_WORKERS == 1 and os.path.exists(TEMP_DIR):
             shutil.rmtree(TEMP_DIR)
 
 
@@ -47,9 +80,176 @@ app = FastAPI(lifespan=lifespan)
 HTML_DIR = "html"
 INDEX_FILE = "index.html"
 TEMP_DIR = "temp"
+# 服务进程数，与 uvicorn、gunicorn 一样读取 WEB_CONCURRENCY；server.py 在导入 main 之前设置。
+# 多个 worker 时限流、临时目录索引和任务状态通过本地 SQLite 文件共享
+SERVER_WORKERS = int(os.environ.get("WEB_CONCURRENCY", "1"))
 MAX_REQUESTS_PER_MINUTE = 30
 FILE_EXPIRY_MINUTES = 30
 MAX_FILE_SIZE_MB = 10
+# 令牌桶限流：每个客户端每分钟回满 MAX_REQUESTS_PER_MINUTE 个令牌
+RATE_LIMIT_BACKEND = "memory" if SERVER_WORKERS == 1 else "sqlite"  # "memory"（单进程）或 "sqlite"（多个 worker 共享）
+RATE_LIMIT_DB_PATH = "rate_limit.sqlite3"
+MAX_RATE_LIMIT_CLIENTS = 10000
+# 各路由每次请求扣除的令牌数，未列出的路由扣 1 个
+# 以 / 结尾的键按前缀匹配；任务的查询、进度和结果不计费，处理开销在提交时已按工作量扣除
+RATE_LIMIT_ROUTE_COSTS = {"/": 0, "/preview": 0.25, "/metrics": 0, "/jobs/": 0}
+# 实际处理（未命中结果缓存）时按 上传字节数 × 帧数 追加扣除，每个单位扣 1 个令牌
+RATE_LIMIT_WORK_UNIT = 16 * 1024 * 1024
+# 临时目录：定期分批清理过期目录，总大小超过配额时从最旧的开始删除
+CLEANUP_INTERVAL_SECONDS = 60
+CLEANUP_BATCH_SIZE = 32
+TEMP_DISK_QUOTA_MB = 1024
+FILE_REGISTRY_BACKEND = "memory" if SERVER_WORKERS == 1 else "sqlite"
+FILE_REGISTRY_DB_PATH = "file_registry.sqlite3"
+# 图像处理工作池：Pillow 在大部分操作中会释放 GIL，默认使用线程池
+PROCESS_POOL_TYPE = "thread"  # "thread" 或 "process"
+PROCESS_WORKERS = max((os.cpu_count() or 1) // SERVER_WORKERS, 1)
+PROCESS_QUEUE_SIZE = PROCESS_WORKERS * 2
+RETRY_AFTER_SECONDS = 5
+# 处理结果缓存
+CACHE_DIR = "cache"
+CACHE_MEMORY_MB = 64
+CACHE_DISK_MB = 512
+# 上传一次、多次调整参数的源图像缓存
+SOURCE_CACHE_MB = 256
+SOURCE_EXPIRY_MINUTES = FILE_EXPIRY_MINUTES
+# 多个 worker 时上传的源图像同时写入共享目录，source_id 落到其他 worker 时从这里读取并重新解码
+SOURCE_STORE_DIR = "sources"
+SOURCE_STORE_DB_PATH = "sources.sqlite3"
+# 实时预览：在缩小的代理图上处理，直接在事件循环中完成，不进入工作池排队
+PREVIEW_MAX_SIZE = 256
+PREVIEW_QUALITY = 60
+# 静态结果超过该大小时写入临时目录再用 FileResponse 返回，否则直接从内存返回
+SPILL_TO_DISK_MB = 8
+# 单次请求的像素预算，只读取文件头即可检查，超出时不会开始解码
+MAX_IMAGE_DIMENSION = 8192
+MAX_FRAMES = 1000
+MAX_TOTAL_PIXELS = 256 * 1024 * 1024  # 宽 × 高 × 帧数
+OVER_BUDGET_ACTION = "reject"  # "reject" 或 "downscale"（自动缩小，仅适用于静态图像）
+# 可选的输出格式；"auto" 保持输入格式，动画 WebP/APNG 保持真彩色，其余动画输出 GIF
+OUTPUT_FORMATS = ("auto", "gif", "webp", "png", "jpeg")
+# 批量处理：一次请求最多的参数组合数
+MAX_BATCH_SPECS = 16
+VALID_SIDES = ("left", "right", "up", "down", "q1", "q2", "q3", "q4")
+# 异步任务（/jobs）：按预估开销排队，开销小的任务先执行
+JOB_WORKERS = PROCESS_WORKERS
+MAX_QUEUED_JOBS = 256
+MAX_JOBS_PER_CLIENT = 16  # 每个客户端排队和执行中的任务总数上限
+MAX_RUNNING_JOBS_PER_CLIENT = max(PROCESS_WORKERS // 2, 1)
+JOB_AGING_MB_PER_SECOND = 64  # 任务每等待 1 秒，调度时视为预估开销减少 64MB
+JOB_RESULT_TTL_SECONDS = FILE_EXPIRY_MINUTES * 60
+MAX_FINISHED_JOBS = 256
+JOB_RETRY_SECONDS = 0.5
+JOB_STORE_DB_PATH = "jobs.sqlite3"  # 多个 worker 时共享任务状态，查询可以落到任意 worker
+JOB_PUBLISH_INTERVAL_SECONDS = 0.25  # 执行中的任务写入共享状态的最短间隔
+JOB_POLL_SECONDS = 0.25  # 其他 worker 的任务通过轮询共享状态推送进度
+JOB_DRAIN_SECONDS = 60  # 关闭时等待排队和执行中的任务完成的最长时间
+# multipart 边界和表单字段的额外开销
+MAX_FORM_OVERHEAD_BYTES = 64 * 1024
+
+LOG_LEVEL = "INFO"  # DEBUG 时输出每个请求的处理细节
+
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+metrics_registry = MetricsRegistry()
+http_requests = metrics_registry.counter("http_requests_total", "HTTP 请求数", ("route", "status"))
+http_request_seconds = metrics_registry.histogram("http_request_duration_seconds",
+                                                  "HTTP 请求耗时（到响应体发送完毕）", ("route",))
+stage_seconds = metrics_registry.histogram("image_stage_duration_seconds", "图像处理各阶段耗时，动画按帧记录",
+                                           ("stage",))
+request_frames = metrics_registry.histogram("image_frames", "每个请求的源图像帧数",
+                                            buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+upload_bytes = metrics_registry.histogram("upload_size_bytes", "上传图像大小", buckets=SIZE_BUCKETS)
+response_bytes = metrics_registry.histogram("response_size_bytes", "响应体大小", ("route",), buckets=SIZE_BUCKETS)
+rate_limit_rejections = metrics_registry.counter("rate_limit_rejections_total", "被限流拒绝的请求数", ("route",))
+pool_rejections = metrics_registry.counter("processing_pool_rejections_total", "工作池已满被拒绝的请求数")
+metrics_registry.gauge("processing_pool_pending", "工作池中正在执行和排队的任务数",
+                       lambda: processing_pool.pending)
+metrics_registry.gauge("processing_pool_capacity", "工作池容量", lambda: processing_pool.capacity)
+metrics_registry.gauge("result_cache_hits_memory_total", "结果缓存内存层命中数",
+                       lambda: result_cache.stats()["hits_memory"], "counter")
+metrics_registry.gauge("result_cache_hits_disk_total", "结果缓存磁盘层命中数",
+                       lambda: result_cache.stats()["hits_disk"], "counter")
+metrics_registry.gauge("result_cache_misses_total", "结果缓存未命中数",
+                       lambda: result_cache.stats()["misses"], "counter")
+metrics_registry.gauge("result_cache_memory_bytes", "结果缓存内存层占用", lambda: result_cache.stats()["memory_bytes"])
+metrics_registry.gauge("source_cache_hits_total", "源图像缓存命中数", lambda: source_cache.stats()["hits"], "counter")
+metrics_registry.gauge("source_cache_misses_total", "源图像缓存未命中数",
+                       lambda: source_cache.stats()["misses"], "counter")
+metrics_registry.gauge("source_cache_bytes", "源图像缓存占用", lambda: source_cache.stats()["bytes"])
+metrics_registry.gauge("jobs_queued", "排队中的异步任务数", lambda: job_scheduler.queued)
+metrics_registry.gauge("jobs_running", "执行中的异步任务数", lambda: job_scheduler.stats()["running"])
+
+# 工作线程中的解码、镜像、量化、编码耗时直接记录到直方图。进程池模式下子进程不回传，这些阶段没有数据。
+image_process.stage_observer = lambda stage, seconds: stage_seconds.observe(seconds, stage)
+
+
+class UploadSizeLimitMiddleware:
+    """
+    在解析表单之前限制请求体大小：先检查 Content-Length，再在接收过程中累计字节数，
+    一旦超过上限立即返回 413，超大的上传不会被完整读入。
+    """
+    def __init__(self, app, max_body_size: int):
+        self.app = app
+        self.max_body_size = max_body_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None:
+            try:
+                declared_size = int(content_length)
+            except ValueError:
+                await self.reject(send, 400, "无效的 Content-Length")
+                return
+            if declared_size > self.max_body_size:
+                await self.reject(send)
+                return
+
+        received = 0
+        too_large = False
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, too_large
+            if too_large:
+                # 不再读取剩余数据，让表单解析尽快结束
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body_size:
+                    too_large = True
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def limited_send(message):
+            nonlocal rejected
+            if too_large:
+                # 表单解析失败后应用会返回 400，这里替换为 413
+                if not rejected:
+                    rejected = True
+                    await self.reject(send)
+                return
+            await send(message)
+
+        await self.app(scope, limited_receive, limited_send)
+
+    async def reject(self, send, status_code: int = 413, detail: str = None):
+        detail = detail or f"文件大小超过最大限制 {MAX_FILE_SIZE_MB}MB"
+        body = json.dumps({"detail": detail}, ensure_ascii=False).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+                        (b"connection", b"close")],
+        })
+        await send({"type": "http.response.body", "body": body})
+
 
 app.add_middleware(
     CORSMiddleware,
@@ -58,153 +258,1197 @@ app.add_middleware(
     allow_methods=["GET", "POST"],
     allow_headers=["Authorization", "Content-Type"]
 )
+app.add_middleware(UploadSizeLimitMiddleware,
+                   max_body_size=MAX_FILE_SIZE_MB * 1024 * 1024 + MAX_FORM_OVERHEAD_BYTES)
 
 
-class RateLimiter:
-    def __init__(self):
-        self.requests = defaultdict(list)
-
-    def is_rate_limited(self, client_id: str) -> bool:
-        current_time = time.time()
-        minute_ago = current_time - 60
-        self.requests[client_id] = [
-            req_time for req_time in self.requests[client_id]
-            if req_time > minute_ago
-        ]
-        return len(self.requests[client_id]) >= MAX_REQUESTS_PER_MINUTE
+def create_rate_limit_backend():
+    if RATE_LIMIT_BACKEND == "sqlite":
+        return SqliteRateLimitBackend(RATE_LIMIT_DB_PATH, MAX_RATE_LIMIT_CLIENTS)
+    return MemoryRateLimitBackend(MAX_RATE_LIMIT_CLIENTS)
 
-    def add_request(self, client_id: str):
-        self.requests[client_id].append(time.time())
 
-
-rate_limiter = RateLimiter()
+rate_limiter = RateLimiter(create_rate_limit_backend(), MAX_REQUESTS_PER_MINUTE, 60, RATE_LIMIT_ROUTE_COSTS)
 
 
 class FileManager:
-    def __init__(self):
+    """
+    临时输出目录管理。目录的最后访问时间和大小记录在 registry 中（单进程用内存，多个 worker 用共享的 SQLite），
+    每次清理只取出已过期或超出配额的目录。索引读写和实际删除都在工作线程中进行，不阻塞事件循环。
+    """
+    def __init__(self, registry):
         self.base_temp_dir = TEMP_DIR
+        self.registry = registry
         self.ensure_base_dir()
-        self.user_dirs: Dict[str, datetime] = {}
+        self.rescan()
 
     def ensure_base_dir(self):
         if not os.path.exists(self.base_temp_dir):
             os.makedirs(self.base_temp_dir)
 
-    def get_user_dir(self, user_id: str) -> str:
+    def rescan(self):
+        # 重启后按修改时间重建索引，上次运行遗留的目录也会按时过期
+        entries = []
+        for user_id in os.listdir(self.base_temp_dir):
+            user_dir = os.path.join(self.base_temp_dir, user_id)
+            if not os.path.isdir(user_dir):
+                continue
+            size = 0
+            last_access = os.stat(user_dir).st_mtime
+            for file_name in os.listdir(user_dir):
+                stat = os.stat(os.path.join(user_dir, file_name))
+                size += stat.st_size
+                last_access = max(last_access, stat.st_mtime)
+            entries.append((last_access, user_id, size))
+        self.registry.reset(sorted(entries))
+
+    async def get_user_dir(self, user_id: str) -> str:
         user_dir = os.path.join(self.base_temp_dir, user_id)
         if not os.path.exists(user_dir):
             os.makedirs(user_dir)
-        self.user_dirs[user_id] = datetime.now()
+        await self.track(user_id, 0)
         return user_dir
 
-    def clean_expired_files(self):
-        current_time = datetime.now()
-        expired_users = []
-        for user_id, last_access in self.user_dirs.items():
-            if current_time - last_access > timedelta(minutes=FILE_EXPIRY_MINUTES):
-                user_dir = os.path.join(self.base_temp_dir, user_id)
-                if os.path.exists(user_dir):
-                    shutil.rmtree(user_dir)
-                expired_users.append(user_id)
-        for user_id in expired_users:
-            del self.user_dirs[user_id]
+    async def track(self, user_id: str, added_bytes: int):
+        """
+        记录一次访问和新写入的字节数，并把目录移到索引末尾。SQLite 索引可能等待其他 worker 的写锁，在工作线程中执行
+        """
+        await asyncio.to_thread(self.registry.track, user_id, added_bytes, time.time())
+
+    def collect_expired(self, limit: int) -> list:
+        """
+        从索引中取出最多 limit 个已过期或超出磁盘配额的目录，返回待删除的路径
+        """
+        user_ids = self.registry.collect_expired(time.time() - FILE_EXPIRY_MINUTES * 60,
+                                                 TEMP_DISK_QUOTA_MB * 1024 * 1024, limit)
+        return [os.path.join(self.base_temp_dir, user_id) for user_id in user_ids]
+
+    @staticmethod
+    def remove_dirs(paths: list):
+        for path in paths:
+            shutil.rmtree(path, ignore_errors=True)
+
+    async def clean_expired_files(self):
+        # 每批删除后让出事件循环，过期目录再多也不会长时间占用
+        while True:
+            paths = await asyncio.to_thread(self.collect_expired, CLEANUP_BATCH_SIZE)
+            if not paths:
+                break
+            await asyncio.to_thread(self.remove_dirs, paths)
+            logger.info("清理临时目录 %s 个", len(paths))
+
+
+def create_file_registry():
+    if FILE_REGISTRY_BACKEND == "sqlite":
+        return SqliteFileRegistry(FILE_REGISTRY_DB_PATH)
+    return MemoryFileRegistry()
+
+
+file_manager = FileManager(create_file_registry())
+
+
+class ProcessingPool:
+    """
+    有界的图像处理工作池，避免 Pillow 计算阻塞事件循环。
+    正在执行和排队的任务总数超过上限时直接返回 503。
+    """
+    def __init__(self, workers: int, queue_size: int, pool_type: str = "thread"):
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.pool_type = pool_type
+        self.pending = 0
+        self.executor = None
+
+    def start(self):
+        if self.executor is not None:
+            return
+        if self.pool_type == "process":
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        elif self.pool_type == "thread":
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="image-worker")
+        else:
+            raise ValueError(f"Invalid pool type: {self.pool_type}")
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    def is_full(self) -> bool:
+        return self.pending >= self.capacity
+
+    def acquire(self):
+        # pending 只在事件循环线程中修改，无需加锁
+        if self.is_full():
+            pool_rejections.inc()
+            raise HTTPException(status_code=503, detail="服务器繁忙，请稍后再试",
+                                headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+        self.start()
+        self.pending += 1
+
+    def release(self):
+        self.pending -= 1
+
+    async def run(self, func, *args):
+        self.acquire()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            self.release()
+
+    def stream(self, func, *args):
+        """
+        逐块产出生成器 func(*args) 的数据，每次只在工作池中推进一步。
+        调用时检查名额（满时直接抛出 503）；之后只在工作池推进生成器期间占用名额，
+        等待慢客户端读取数据时不占用，避免慢连接占满工作池。
+        进程池无法跨进程传递生成器，此时在子进程中一次性产出全部数据。
+        """
+        self.acquire()
+
+        async def chunks():
+            held = True
+            try:
+                loop = asyncio.get_running_loop()
+                if self.pool_type == "process":
+                    data = await loop.run_in_executor(self.executor, collect_chunks, func, *args)
+                    self.release()
+                    held = False
+                    yield data
+                    return
+                generator = func(*args)
+                while True:
+                    if not held:
+                        # 已经接收的流继续推进时不再检查上限，只计入正在执行的数量
+                        self.pending += 1
+                        held = True
+                    chunk = await loop.run_in_executor(self.executor, next, generator, None)
+                    self.release()
+                    held = False
+                    if chunk is None:
+                        break
+                    if chunk:
+                        yield chunk
+            finally:
+                if held:
+                    self.release()
+
+        return chunks()
+
+
+processing_pool = ProcessingPool(PROCESS_WORKERS, PROCESS_QUEUE_SIZE, PROCESS_POOL_TYPE)
+
+result_cache = ResultCache(CACHE_DIR, CACHE_MEMORY_MB * 1024 * 1024, CACHE_DISK_MB * 1024 * 1024,
+                           MAX_FILE_SIZE_MB * 1024 * 1024 * 4)
+source_cache = SourceCache(SOURCE_CACHE_MB * 1024 * 1024, SOURCE_EXPIRY_MINUTES * 60)
+job_scheduler = JobScheduler(JOB_WORKERS, MAX_RUNNING_JOBS_PER_CLIENT, JOB_AGING_MB_PER_SECOND,
+                             JOB_RESULT_TTL_SECONDS, MAX_FINISHED_JOBS)
+job_store = SqliteJobStore(JOB_STORE_DB_PATH) if SERVER_WORKERS > 1 else None
+# 任务状态的写入只有这一个线程，保证同一任务的状态按发生顺序落盘
+job_state_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-state") if job_store is not None else None
+source_store = SqliteSourceStore(SOURCE_STORE_DB_PATH, SOURCE_STORE_DIR) if SERVER_WORKERS > 1 else None
+
+# 像素预算由 check_pixel_budget 检查；Pillow 自带的解压炸弹检查与预算对齐，
+# 超过预算 2 倍时 Image.open 直接报错（open_source 返回 413），介于两者之间的警告不再重复输出
+Image.MAX_IMAGE_PIXELS = MAX_TOTAL_PIXELS
+warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+
+
+def collect_chunks(func, *args) -> bytes:
+    return b"".join(func(*args))
+
+
+def report_progress(frame_items, progress=None):
+    # 每产出一帧调用一次 progress(已处理帧数)
+    if progress is None:
+        yield from frame_items
+        return
+    for frames_done, item in enumerate(frame_items, 1):
+        progress(frames_done)
+        yield item
+
+
+def render_animation(content: bytes, horizontal_crop_percent: int, vertical_crop_percent: int, selected_side: str,
+                     progress=None):
+    """
+    在工作池中逐帧执行的动画处理流程：解码、镜像、量化、编码都按帧流水进行，
+    每次产出一帧编码后的 GIF 数据，内存占用与帧数无关。
+    """
+    image = Image.open(io.BytesIO(content))
+    frame_items = iter_animated_image(image, horizontal_crop_percent, vertical_crop_percent, selected_side)
+    yield from encode_gif_stream(report_progress(frame_items, progress), loop=0, disposal=2)
+
+
+def render_animation_truecolor(content: bytes, horizontal_crop_percent: int, vertical_crop_percent: int,
+                               selected_side: str, output_format: str, save_options: dict, progress=None) -> bytes:
+    """
+    动画 WebP/APNG 输出：帧保持 RGBA 真彩色，跳过调色板量化，由编码器直接压缩
+    """
+    image = Image.open(io.BytesIO(content))
+    frame_items = mirror_rgba_frames(iter_rgba_frames(image), image.size, horizontal_crop_percent,
+                                     vertical_crop_percent, selected_side, palette_mode="none")
+    return encode_animation(report_progress(frame_items, progress), output_format, **save_options)
+
+
+def render_job(source, is_animated: bool, horizontal_crop_percent: int, vertical_crop_percent: int,
+               selected_side: str, actual_format: str, target_size: tuple = None, save_options: dict = None,
+               progress=None) -> bytes:
+    """
+    异步任务在工作池中的处理流程，一次返回完整结果
+    """
+    save_options = save_options or {}
+    if not is_animated:
+        return render_static_image(source, horizontal_crop_percent, vertical_crop_percent, selected_side,
+                                   actual_format, target_size, save_options)
+    if actual_format != "gif":
+        return render_animation_truecolor(source, horizontal_crop_percent, vertical_crop_percent, selected_side,
+                                          actual_format, save_options, progress)
+    return b"".join(render_animation(source, horizontal_crop_percent, vertical_crop_percent, selected_side,
+                                     progress))
+
+
+def render_batch(source, specs: list, actual_format: str, is_animated: bool, target_size: tuple = None,
+                 save_options: dict = None) -> list:
+    """
+    在工作池中执行的批量处理：源图像只解码一次，每帧只转换一次 RGBA，再分发给所有参数组合。
+    specs 是 (selected_side, horizontal_crop_percent, vertical_crop_percent) 的列表，返回与之对应的编码结果。
+    """
+    save_options = save_options or {}
+    if is_animated and actual_format == "gif":
+        return render_animation_batch(source, specs)
+    if is_animated:
+        return render_animation_batch_truecolor(source, specs, actual_format, save_options)
+
+    if isinstance(source, Image.Image):
+        image = source.convert('RGBA')
+        return [encode_static_image(process_static_image(image, horizontal_crop_percent, vertical_crop_percent,
+                                                         selected_side), actual_format, save_options)
+                for selected_side, horizontal_crop_percent, vertical_crop_percent in specs]
+
+    # 只解码所有参数组合用到的源区域的并集，区域按原始方向计算，转正与镜像合并进行
+    image = Image.open(io.BytesIO(source))
+    orientation = exif_orientation(image)
+    boxes = [source_region_oriented(target_size or image.size, horizontal_crop_percent, vertical_crop_percent,
+                                    selected_side, orientation)
+             for selected_side, horizontal_crop_percent, vertical_crop_percent in specs]
+    union = union_region(boxes)
+    region = load_image_region(image, union, target_size).convert('RGBA')
+    results = []
+    for (selected_side, _, _), box in zip(specs, boxes):
+        cropped = region.crop((box[0] - union[0], box[1] - union[1], box[2] - union[0], box[3] - union[1]))
+        results.append(encode_static_image(mirror_oriented_region(cropped, selected_side, orientation),
+                                           actual_format, save_options))
+    return results
+
+
+def render_animation_batch(content: bytes, specs: list) -> list:
+    """
+    解码后的帧通过 itertools.tee 分发给每个参数组合的处理流程，与单独处理时一样保留 GIF 的调色板快速路径。
+    各流程轮流前进一帧，tee 只需缓存流程之间相差的几帧（调色板抽样窗口），而不是整段动画。
+    """
+    image = Image.open(io.BytesIO(content))
+    transparency_index = image.info.get('transparency', None)
+    frame_streams = itertools.tee(iter_rgba_frames(image, keep_indexed=True), len(specs))
+    encoders = [encode_gif_stream(mirror_rgba_frames(frames, image.size, horizontal_crop_percent,
+                                                     vertical_crop_percent, selected_side,
+                                                     transparency_index=transparency_index))
+                for frames, (selected_side, horizontal_crop_percent, vertical_crop_percent)
+                in zip(frame_streams, specs)]
+    outputs = [[] for _ in specs]
+    active = list(range(len(specs)))
+    while active:
+        for index in list(active):
+            chunk = next(encoders[index], None)
+            if chunk is None:
+                active.remove(index)
+            else:
+                outputs[index].append(chunk)
+    return [b"".join(chunks) for chunks in outputs]
+
+
+def render_animation_batch_truecolor(content: bytes, specs: list, output_format: str, save_options: dict) -> list:
+    # 不量化时每个流程输入一帧就产出一帧，用 zip 同步推进即可
+    image = Image.open(io.BytesIO(content))
+    frame_streams = itertools.tee(iter_rgba_frames(image), len(specs))
+    mirrored_streams = [mirror_rgba_frames(frames, image.size, horizontal_crop_percent, vertical_crop_percent,
+                                           selected_side, palette_mode="none")
+                        for frames, (selected_side, horizontal_crop_percent, vertical_crop_percent)
+                        in zip(frame_streams, specs)]
+    collected = [[] for _ in specs]
+    for frame_items in zip(*mirrored_streams):
+        for frames, frame_item in zip(collected, frame_items):
+            frames.append(frame_item)
+    return [encode_animation(frames, output_format, **save_options) for frames in collected]
+
+
+def write_file(path: str, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def inspect_source(content: bytes) -> tuple:
+    """
+    只读取文件头：返回 (格式, 尺寸, 帧数, 模式)，不解码像素。
+    GIF 的 n_frames 需要跳读每一帧的数据块，但不做 LZW 解码，耗时受上传大小限制；帧数超过 MAX_FRAMES 由 check_pixel_budget 拒绝。
+    """
+    image = Image.open(io.BytesIO(content))
+    mode = image.mode
+    return image.format.lower(), image.size, getattr(image, "n_frames", 1), mode
+
+
+def check_pixel_budget(size: tuple, frame_count: int, is_animated: bool):
+    """
+    检查单次请求的像素预算。在预算内返回 None；超出时按 OVER_BUDGET_ACTION 抛出 413，
+    或返回静态图像自动缩小后的目标尺寸。
+    """
+    width, height = size
+    total_pixels = width * height * frame_count
+    if frame_count > MAX_FRAMES:
+        raise HTTPException(status_code=413, detail=f"帧数超过最大限制 {MAX_FRAMES}")
+    if max(width, height) <= MAX_IMAGE_DIMENSION and total_pixels <= MAX_TOTAL_PIXELS:
+        return None
+    if OVER_BUDGET_ACTION != "downscale" or is_animated:
+        raise HTTPException(status_code=413,
+                            detail=f"图像过大: {width}x{height}x{frame_count}，"
+                                   f"最大尺寸 {MAX_IMAGE_DIMENSION}，最大总像素 {MAX_TOTAL_PIXELS}")
+    scale = min(MAX_IMAGE_DIMENSION / width, MAX_IMAGE_DIMENSION / height,
+                (MAX_TOTAL_PIXELS / total_pixels) ** 0.5)
+    target_size = (max(int(width * scale), 1), max(int(height * scale), 1))
+    logger.info("图像超出像素预算，自动缩小: %sx%s -> %sx%s", width, height, target_size[0], target_size[1])
+    return target_size
+
+
+def decode_source(content: bytes, is_animated: bool, target_size: tuple = None) -> tuple:
+    """
+    返回 (解码后的静态图像或 None, 预览代理图)
+    """
+    image = Image.open(io.BytesIO(content))
+    decoded = None
+    if not is_animated:
+        # 缓存的图像之后会按不同参数反复镜像，上传时转正一次
+        orientation = exif_orientation(image)
+        image = decoded = correct_image_orientation(load_image_scaled(image, target_size), orientation)
+    return decoded, build_preview_proxy(image, PREVIEW_MAX_SIZE)
+
+
+def render_preview(proxy: Image.Image, horizontal_crop_percent: int, vertical_crop_percent: int,
+                   selected_side: str, preview_format: str) -> bytes:
+    result = process_static_image(proxy, horizontal_crop_percent, vertical_crop_percent, selected_side)
+    buffer = io.BytesIO()
+    if preview_format == "webp":
+        # method=0 是最快的 WebP 编码档位，预览不需要高压缩率
+        result.save(buffer, format="WEBP", quality=PREVIEW_QUALITY, method=0)
+    else:
+        # PNG 不压缩，避免 zlib 耗时
+        result.save(buffer, format="PNG", compress_level=0)
+    return buffer.getvalue()
+
 
+def render_static_image(source, horizontal_crop_percent: int, vertical_crop_percent: int,
+                        selected_side: str, actual_format: str, target_size: tuple = None,
+                        save_options: dict = None) -> bytes:
+    """
+    在工作池中执行的静态图像处理流程：解码、镜像，并编码到内存中返回。
+    source 可以是原始字节，也可以是源图像缓存中已解码的 Image。
+    """
+    if isinstance(source, Image.Image):
+        result = process_static_image(source, horizontal_crop_percent, vertical_crop_percent, selected_side)
+    else:
+        # 只解码镜像用到的源区域
+        result = process_static_image_region(Image.open(io.BytesIO(source)), horizontal_crop_percent,
+                                             vertical_crop_percent, selected_side, target_size)
+    return encode_static_image(result, actual_format, save_options)
+
+
+def encode_static_image(result: Image.Image, actual_format: str, save_options: dict = None) -> bytes:
+    # 根据原始图像格式保存
+    start = time.perf_counter()
+    save_options = save_options or {}
+    buffer = io.BytesIO()
+    if actual_format in ['jpeg', 'jpg']:
+        if result.mode != "RGB":
+            logger.debug("转换静态图像模式为 RGB 以兼容 JPEG")
+            result = result.convert("RGB")
+        result.save(buffer, format='JPEG', **save_options)
+    elif actual_format == 'png':
+        result.save(buffer, format='PNG')
+    else:
+        # 对于其他格式，使用原始格式保存
+        result.save(buffer, format=actual_format.upper(), **save_options)
+    record_stage("encode", start)
+    return buffer.getvalue()
 
-file_manager = FileManager()
+
+def client_key(request: Request) -> str:
+    return request.client.host if request.client else "unknown"
+
+
+def route_label(path: str) -> str:
+    # 指标标签使用注册的路由模板（例如 /jobs/{job_id}），未知路径统一记为 other，避免标签数量无限增长
+    for route in app.routes:
+        if route.path_regex.match(path):
+            return route.path
+    return "other"
 
 
 @app.middleware("http")
 async def rate_limit_middleware(request: Request, call_next):
-    client_ip = request.client.host
-    if rate_limiter.is_rate_limited(client_ip):
-        raise HTTPException(status_code=429, detail="Too many requests. Please try again later.")
-    rate_limiter.add_request(client_ip)
+    # SQLite 后端在 BEGIN IMMEDIATE 上等待其他 worker 的写锁，不能在事件循环中执行
+    allowed, retry_after = await asyncio.to_thread(rate_limiter.check, client_key(request), request.url.path)
+    if not allowed:
+        rate_limit_rejections.inc(1, route_label(request.url.path))
+        # 中间件里抛出的 HTTPException 不会被异常处理器转换，直接返回响应
+        return JSONResponse(
+            status_code=429,
+            content={"detail": "Too many requests. Please try again later."},
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
     response = await call_next(request)
     return response
 
 
+class MetricsMiddleware:
+    """
+    最外层的中间件，记录每个请求的状态码、总耗时、响应体大小，以及从开始发送响应到发送完毕的耗时（response 阶段）。
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        response_start = None
+        status = 500
+        sent_bytes = 0
+
+        async def measured_send(message):
+            nonlocal response_start, status, sent_bytes
+            if message["type"] == "http.response.start":
+                response_start = time.perf_counter()
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent_bytes += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, measured_send)
+        finally:
+            end = time.perf_counter()
+            route = route_label(scope["path"])
+            http_requests.inc(1, route, status)
+            http_request_seconds.observe(end - start, route)
+            response_bytes.observe(sent_bytes, route)
+            if response_start is not None:
+                stage_seconds.observe(end - response_start, "response")
+
+
+app.add_middleware(MetricsMiddleware)
+
+
+def validate_crop_params(selected_side: str, horizontal_crop_percent: int, vertical_crop_percent: int):
+    """
+    在进入工作池之前拒绝无效参数，返回 400 而不是处理时的 500。
+    检查的是 normalize_crop_percent 换算后实际保留的比例，例如 right 方向的 100 会得到空的裁切区域。
+    """
+    if selected_side not in VALID_SIDES:
+        raise HTTPException(status_code=400, detail=f"Invalid selected_side: {selected_side}")
+    horizontal_crop_percent, vertical_crop_percent = normalize_crop_percent(
+        horizontal_crop_percent, vertical_crop_percent, selected_side)
+    if not (0 < horizontal_crop_percent <= 100 and 0 < vertical_crop_percent <= 100):
+        raise HTTPException(status_code=400, detail="裁切比例超出范围，保留的区域必须在 1% 到 100% 之间")
+
+
+def normalize_crop_percent(horizontal_crop_percent: int, vertical_crop_percent: int, selected_side: str) -> tuple:
+    if selected_side == "right" or selected_side == "q2" or selected_side == "q3":
+        horizontal_crop_percent = 100 - horizontal_crop_percent
+    if selected_side == "down" or selected_side == "q3" or selected_side == "q4":
+        vertical_crop_percent = 100 - vertical_crop_percent
+    return horizontal_crop_percent, vertical_crop_percent
+
+
+async def read_upload(file: UploadFile) -> bytes:
+    """
+    Starlette 在解析表单时已把文件写入 SpooledTemporaryFile（超过 1MB 落盘），
+    这里先按记录的大小拒绝，再一次性读成 bytes；之后 Image.open(io.BytesIO(content)) 与 content 共享内存，不会再复制。
+    """
+    if file.size is not None and file.size > MAX_FILE_SIZE_MB * 1024 * 1024:
+        raise HTTPException(status_code=413, detail=f"文件大小超过最大限制 {MAX_FILE_SIZE_MB}MB")
+    start = time.perf_counter()
+    content = await file.read()
+    stage_seconds.observe(time.perf_counter() - start, "upload_read")
+    upload_bytes.observe(len(content))
+    if len(content) > MAX_FILE_SIZE_MB * 1024 * 1024:
+        raise HTTPException(status_code=413, detail=f"文件大小超过最大限制 {MAX_FILE_SIZE_MB}MB")
+    return content
+
+
+async def open_source(content: bytes) -> CachedSource:
+    # 更智能的文件类型检测
+    try:
+        # 尝试从文件内容判断真正的文件类型，只读取文件头
+        actual_format, size, frame_count, mode = await asyncio.to_thread(inspect_source, content)
+        logger.debug("实际图像格式: %s", actual_format)
+    except Image.DecompressionBombError as e:
+        raise HTTPException(status_code=413, detail=f"图像过大: {str(e)}")
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"无法打开图像: {str(e)}")
+
+    is_animated = frame_count > 1
+    logger.debug("Processing image. Is animated: %s", is_animated)
+    request_frames.observe(frame_count)
+    is_animated = is_animated or actual_format == 'gif'
+    target_size = check_pixel_budget(size, frame_count, is_animated)
+    digest = await asyncio.to_thread(content_digest, content)
+    return CachedSource(content, digest, actual_format, is_animated, target_size=target_size, frame_count=frame_count,
+                        dimensions=size, mode=mode)
+
+
+def resolve_output(source: CachedSource, output_format: str, quality: Optional[int], lossless: bool,
+                   webp_method: Optional[int]) -> tuple:
+    """
+    确定输出格式和编码参数，返回 (格式, 保存参数, 缓存键后缀)。
+    WebP 支持 quality、lossless 和 method（0 最快，6 压缩率最高）；JPEG 只支持 quality。
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"不支持的输出格式: {output_format}")
+    if output_format == "auto":
+        if not source.is_animated:
+            output_format = source.image_format
+        elif source.image_format in ("webp", "png"):
+            output_format = source.image_format
+        else:
+            output_format = "gif"
+    if source.is_animated and output_format not in ("gif", "webp", "png"):
+        raise HTTPException(status_code=400, detail=f"动画不支持输出为 {output_format}")
+
+    save_options = {}
+    if output_format == "webp":
+        if quality is not None:
+            save_options["quality"] = quality
+        if lossless:
+            save_options["lossless"] = True
+        if webp_method is not None:
+            if not 0 <= webp_method <= 6:
+                raise HTTPException(status_code=400, detail="webp_method 必须在 0 到 6 之间")
+            save_options["method"] = webp_method
+    elif output_format in ("jpeg", "jpg") and quality is not None:
+        save_options["quality"] = quality
+    if "quality" in save_options and not 0 <= quality <= 100:
+        raise HTTPException(status_code=400, detail="quality 必须在 0 到 100 之间")
+
+    variant = "-".join([output_format] + [f"{key}{value}" for key, value in sorted(save_options.items())])
+    return output_format, save_options, variant
+
+
+def result_headers(user_id: str, cache_key: str, cache_status: str) -> dict:
+    # 缓存键由内容哈希和处理参数组成，可以直接作为强 ETag
+    return {"X-User-ID": user_id, "X-Cache": cache_status, "ETag": f'"{cache_key}"'}
+
+
+async def respond_processed(source: CachedSource, horizontal_crop_percent: int, vertical_crop_percent: int,
+                            selected_side: str, client_id: str, output: tuple):
+    user_id = str(uuid.uuid4())
+    actual_format, save_options, variant = output
+
+    # 相同内容和参数的结果直接从缓存返回，不需要解码
+    cache_key = make_cache_key(source.digest, horizontal_crop_percent, vertical_crop_percent, selected_side,
+                               variant)
+    cached = await asyncio.to_thread(result_cache.get, cache_key)
+    if cached is not None:
+        data, cached_format = cached
+        logger.debug("缓存命中: %s", cache_key)
+        return Response(
+            content=data,
+            media_type=f"image/{cached_format}",
+            headers=result_headers(user_id, cache_key, "HIT")
+        )
+
+    # 缓存未命中才真正处理，按工作量追加扣除令牌
+    await asyncio.to_thread(rate_limiter.charge, client_id,
+                            len(source.content) * source.frame_count // RATE_LIMIT_WORK_UNIT)
+
+    # 解码和镜像在工作池中完成，事件循环只负责收发数据
+    if source.is_animated and actual_format != "gif":
+        data = await processing_pool.run(render_animation_truecolor, source.content, horizontal_crop_percent,
+                                         vertical_crop_percent, selected_side, actual_format, save_options)
+        await asyncio.to_thread(result_cache.put, cache_key, data, actual_format)
+        return Response(
+            content=data,
+            media_type=f"image/{actual_format}",
+            headers=result_headers(user_id, cache_key, "MISS")
+        )
+
+    if source.is_animated:
+        chunks = processing_pool.stream(render_animation, source.content, horizontal_crop_percent,
+                                        vertical_crop_percent, selected_side)
+        # 先取出第一块（文件头和第一帧），处理出错时仍能返回错误状态码
+        first_chunk = await anext(chunks)
+
+        async def body():
+            produced = [first_chunk]
+            produced_bytes = len(first_chunk)
+            yield first_chunk
+            async for chunk in chunks:
+                if produced is not None:
+                    produced_bytes += len(chunk)
+                    if produced_bytes <= result_cache.max_entry_bytes:
+                        produced.append(chunk)
+                    else:
+                        # 超过单条缓存上限的结果不会被缓存，不再保留已发送的数据
+                        produced = None
+                yield chunk
+            # 完整发送后才写入缓存
+            if produced is not None:
+                await asyncio.to_thread(result_cache.put, cache_key, b"".join(produced), actual_format)
+
+        return StreamingResponse(
+            body(),
+            media_type=f"image/{actual_format}",
+            headers=result_headers(user_id, cache_key, "MISS")
+        )
+
+    decoded = source.decoded if source.decoded is not None else source.content
+    data = await processing_pool.run(render_static_image, decoded, horizontal_crop_percent, vertical_crop_percent,
+                                     selected_side, actual_format, source.target_size, save_options)
+    await asyncio.to_thread(result_cache.put, cache_key, data, actual_format)
+
+    if len(data) <= SPILL_TO_DISK_MB * 1024 * 1024:
+        logger.debug("图像处理成功。直接从内存返回 %s 字节", len(data))
+        return Response(
+            content=data,
+            media_type=f"image/{actual_format}",
+            headers=result_headers(user_id, cache_key, "MISS")
+        )
+
+    # 超大结果写入临时目录，由 FileResponse 分块发送，不在内存中长时间持有
+    output_filename = f"processed_image.{actual_format}"
+    user_dir = await file_manager.get_user_dir(user_id)
+    output_path = os.path.join(user_dir, output_filename)
+    await asyncio.to_thread(write_file, output_path, data)
+    await file_manager.track(user_id, len(data))
+    del data
+
+    logger.debug("图像处理成功。保存至 %s", output_path)
+    return FileResponse(
+        output_path,
+        media_type=f"image/{actual_format}",
+        headers=result_headers(user_id, cache_key, "MISS")
+    )
+
+
 @app.post("/process-image")
 async def process_image(
         request: Request,
         file: UploadFile = File(...),
         horizontal_crop_percent: int = Form(...),
         vertical_crop_percent: int = Form(...),
-        selected_side: str = Form(...)
+        selected_side: str = Form(...),
+        output_format: str = Form("auto"),
+        quality: Optional[int] = Form(None),
+        lossless: bool = Form(False),
+        webp_method: Optional[int] = Form(None)
 ):
-    if selected_side == "right" or selected_side == "q2" or selected_side == "q3":
-        horizontal_crop_percent = 100 - horizontal_crop_percent
-    if selected_side == "down" or selected_side == "q3" or selected_side == "q4":
-        vertical_crop_percent = 100 - vertical_crop_percent
+    validate_crop_params(selected_side, horizontal_crop_percent, vertical_crop_percent)
+    horizontal_crop_percent, vertical_crop_percent = normalize_crop_percent(
+        horizontal_crop_percent, vertical_crop_percent, selected_side)
 
     try:
-        content = await file.read()
-        if len(content) > MAX_FILE_SIZE_MB * 1024 * 1024:
-            raise HTTPException(status_code=413, detail=f"文件大小超过最大限制 {MAX_FILE_SIZE_MB}MB")
+        content = await read_upload(file)
+        source = await open_source(content)
+        output = resolve_output(source, output_format, quality, lossless, webp_method)
+        return await respond_processed(source, horizontal_crop_percent, vertical_crop_percent, selected_side,
+                                       client_key(request), output)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("处理图像时发生未处理的错误: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
 
-        user_id = str(uuid.uuid4())
-        user_dir = file_manager.get_user_dir(user_id)
 
-        # 更智能的文件类型检测
-        try:
-            # 尝试从文件内容判断真正的文件类型
-            image = Image.open(io.BytesIO(content))
-
-            # 获取真实的图像格式
-            actual_format = image.format.lower()
-            print(f"实际图像格式: {actual_format}")
-
-            # 为输出文件选择正确的扩展名
-            output_filename = f"processed_image.{actual_format.lower()}"
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"无法打开图像: {str(e)}")
-
-        output_path = os.path.join(user_dir, output_filename)
-
-        is_animated = getattr(image, "is_animated", False)
-        print(f"Processing image. Is animated: {is_animated}")
-
-        if is_animated or actual_format == 'gif':
-            frames, durations, disposal_methods = process_animated_image_combined(image, horizontal_crop_percent,
-                                                                                  vertical_crop_percent, selected_side)
-
-            # 保存动画 GIF
-            frames[0].save(
-                output_path,
-                save_all=True,
-                append_images=frames[1:],
-                duration=durations,
-                # transparency=frames[0].info['transparency'],
-                disposal=2,
-                loop=0
-            )
+@app.post("/upload-image")
+async def upload_image(file: UploadFile = File(...)):
+    """
+    只上传一次源图像，返回 source_id；之后调整参数时调用 /process-source，无需重新上传和解码。
+    """
+    try:
+        content = await read_upload(file)
+        source = await open_source(content)
+        source.decoded, source.proxy = await processing_pool.run(decode_source, content, source.is_animated,
+                                                                 source.target_size)
+        source_id = source_cache.put(source)
+        if source_store is not None:
+            meta = {"format": source.image_format, "is_animated": source.is_animated,
+                    "target_size": source.target_size, "frame_count": source.frame_count,
+                    "dimensions": source.dimensions, "mode": source.mode}
+            await asyncio.to_thread(source_store.save, source_id, source.digest, content, meta, time.time())
+        return {
+            "source_id": source_id,
+            "format": source.image_format,
+            "is_animated": source.is_animated,
+            "expires_in": SOURCE_EXPIRY_MINUTES * 60,
+        }
 
-        else:
-            result = process_static_image(image, horizontal_crop_percent, vertical_crop_percent, selected_side)
-
-            # 根据原始图像格式保存
-            if actual_format in ['jpeg', 'jpg']:
-                if result.mode != "RGB":
-                    print("转换静态图像模式为 RGB 以兼容 JPEG")
-                    result = result.convert("RGB")
-                result.save(output_path, format='JPEG')
-            elif actual_format == 'png':
-                result.save(output_path, format='PNG')
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("上传图像时发生未处理的错误: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/process-source")
+async def process_source(
+        request: Request,
+        source_id: str = Form(...),
+        horizontal_crop_percent: int = Form(...),
+        vertical_crop_percent: int = Form(...),
+        selected_side: str = Form(...),
+        output_format: str = Form("auto"),
+        quality: Optional[int] = Form(None),
+        lossless: bool = Form(False),
+        webp_method: Optional[int] = Form(None)
+):
+    validate_crop_params(selected_side, horizontal_crop_percent, vertical_crop_percent)
+    horizontal_crop_percent, vertical_crop_percent = normalize_crop_percent(
+        horizontal_crop_percent, vertical_crop_percent, selected_side)
+
+    source = await find_source(source_id)
+
+    try:
+        output = resolve_output(source, output_format, quality, lossless, webp_method)
+        return await respond_processed(source, horizontal_crop_percent, vertical_crop_percent, selected_side,
+                                       client_key(request), output)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("处理图像时发生未处理的错误: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/preview")
+async def preview(
+        source_id: str = Form(...),
+        horizontal_crop_percent: int = Form(...),
+        vertical_crop_percent: int = Form(...),
+        selected_side: str = Form(...),
+        preview_format: str = Form("webp")
+):
+    """
+    低分辨率实时预览：只处理缓存的代理图（动画只取第一帧），最终结果仍通过 /process-source 生成。
+    """
+    validate_crop_params(selected_side, horizontal_crop_percent, vertical_crop_percent)
+    horizontal_crop_percent, vertical_crop_percent = normalize_crop_percent(
+        horizontal_crop_percent, vertical_crop_percent, selected_side)
+    if preview_format not in ("webp", "png"):
+        raise HTTPException(status_code=400, detail=f"不支持的预览格式: {preview_format}")
+
+    source = await find_source(source_id)
+
+    try:
+        data = render_preview(source.proxy, horizontal_crop_percent, vertical_crop_percent, selected_side,
+                              preview_format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return Response(content=data, media_type=f"image/{preview_format}")
+
+
+async def find_source(source_id: str) -> CachedSource:
+    """
+    按 source_id 取出源图像。本进程缓存中没有时从共享存储读取原始字节，重新解码后放入本进程缓存。
+    """
+    source = source_cache.get(source_id)
+    if source is not None:
+        if source_store is not None:
+            # 刷新共享存储中的访问时间，只在本 worker 上使用的源图像不会在共享存储中先过期
+            await asyncio.to_thread(source_store.touch, source_id, time.time())
+        return source
+    stored = await asyncio.to_thread(source_store.load, source_id, time.time()) if source_store is not None else None
+    if stored is None:
+        raise HTTPException(status_code=404, detail="源图像不存在或已过期，请重新上传")
+    digest, content, meta = stored
+    target_size = tuple(meta["target_size"]) if meta["target_size"] else None
+    dimensions = tuple(meta["dimensions"]) if meta["dimensions"] else None
+    source = CachedSource(content, digest, meta["format"], meta["is_animated"], target_size=target_size,
+                          frame_count=meta["frame_count"], dimensions=dimensions, mode=meta["mode"])
+    source.decoded, source.proxy = await processing_pool.run(decode_source, content, source.is_animated,
+                                                             source.target_size)
+    source_cache.put(source, source_id)
+    return source
+
+
+async def request_source(file: Optional[UploadFile], source_id: Optional[str]) -> CachedSource:
+    # 使用上传的文件，或 /upload-image 返回的 source_id
+    if source_id is not None:
+        return await find_source(source_id)
+    if file is not None:
+        return await open_source(await read_upload(file))
+    raise HTTPException(status_code=400, detail="需要上传文件或提供 source_id")
+
+
+def parse_batch_specs(specs: str) -> list:
+    """
+    解析批量参数，接受 [{"selected_side": "left", "horizontal_crop_percent": 50, "vertical_crop_percent": 50}, ...]
+    """
+    try:
+        items = json.loads(specs)
+        parsed = [(item["selected_side"], int(item["horizontal_crop_percent"]), int(item["vertical_crop_percent"]))
+                  for item in items]
+    except (ValueError, TypeError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"无法解析批量参数: {str(e)}")
+    if not parsed:
+        raise HTTPException(status_code=400, detail="批量参数不能为空")
+    if len(parsed) > MAX_BATCH_SPECS:
+        raise HTTPException(status_code=400, detail=f"批量参数最多 {MAX_BATCH_SPECS} 组")
+    for selected_side, horizontal_crop_percent, vertical_crop_percent in parsed:
+        validate_crop_params(selected_side, horizontal_crop_percent, vertical_crop_percent)
+    return parsed
+
+
+def build_zip(entries: list) -> bytes:
+    # 图像本身已经压缩，直接存储
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        for file_name, data, _ in entries:
+            archive.writestr(file_name, data)
+    return buffer.getvalue()
+
+
+def build_multipart(entries: list, boundary: str) -> bytes:
+    parts = []
+    for file_name, data, media_type in entries:
+        parts.append(f"--{boundary}\r\nContent-Type: {media_type}\r\n"
+                     f"Content-Disposition: attachment; filename=\"{file_name}\"\r\n"
+                     f"Content-Length: {len(data)}\r\n\r\n".encode("utf-8"))
+        parts.append(data)
+        parts.append(b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode("utf-8"))
+    return b"".join(parts)
+
+
+@app.post("/process-batch")
+async def process_batch(
+        request: Request,
+        file: Optional[UploadFile] = File(None),
+        source_id: Optional[str] = Form(None),
+        specs: str = Form(...),
+        response_format: str = Form("zip"),
+        output_format: str = Form("auto"),
+        quality: Optional[int] = Form(None),
+        lossless: bool = Form(False),
+        webp_method: Optional[int] = Form(None)
+):
+    """
+    一次上传、一次解码，生成多组镜像结果。可以上传文件，也可以使用 /upload-image 返回的 source_id。
+    结果以 ZIP（默认）或 multipart/mixed 返回，文件名按参数顺序编号。
+    """
+    if response_format not in ("zip", "multipart"):
+        raise HTTPException(status_code=400, detail=f"不支持的返回格式: {response_format}")
+    parsed = parse_batch_specs(specs)
+
+    try:
+        source = await request_source(file, source_id)
+        actual_format, save_options, variant = resolve_output(source, output_format, quality, lossless, webp_method)
+        results = [None] * len(parsed)
+        cache_keys = []
+        pending = []
+        for index, (selected_side, horizontal_crop_percent, vertical_crop_percent) in enumerate(parsed):
+            horizontal_crop_percent, vertical_crop_percent = normalize_crop_percent(
+                horizontal_crop_percent, vertical_crop_percent, selected_side)
+            cache_key = make_cache_key(source.digest, horizontal_crop_percent, vertical_crop_percent, selected_side,
+                                       variant)
+            cache_keys.append(cache_key)
+            cached = await asyncio.to_thread(result_cache.get, cache_key)
+            if cached is not None:
+                results[index] = cached[0]
             else:
-                # 对于其他格式，使用原始格式保存
-                result.save(output_path, format=actual_format.upper())
+                pending.append((index, (selected_side, horizontal_crop_percent, vertical_crop_percent)))
 
-        print(f"图像处理成功。保存至 {output_path}")
-        return FileResponse(
-            output_path,
-            media_type=f"image/{actual_format}",
-            headers={"X-User-ID": user_id}
-        )
+        logger.debug("批量处理 %s 组参数，缓存命中 %s 组", len(parsed), len(parsed) - len(pending))
+        if pending:
+            await asyncio.to_thread(rate_limiter.charge, client_key(request),
+                                    len(source.content) * source.frame_count * len(pending) // RATE_LIMIT_WORK_UNIT)
+            decoded = source.decoded if source.decoded is not None else source.content
+            outputs = await processing_pool.run(render_batch, decoded, [spec for _, spec in pending],
+                                                actual_format, source.is_animated, source.target_size, save_options)
+            for (index, _), data in zip(pending, outputs):
+                results[index] = data
+                await asyncio.to_thread(result_cache.put, cache_keys[index], data, actual_format)
 
+        entries = [(f"{index + 1:02d}_{selected_side}_{horizontal_crop_percent}_{vertical_crop_percent}.{actual_format}",
+                    data, f"image/{actual_format}")
+                   for index, ((selected_side, horizontal_crop_percent, vertical_crop_percent), data)
+                   in enumerate(zip(parsed, results))]
+        if response_format == "zip":
+            return Response(content=await asyncio.to_thread(build_zip, entries), media_type="application/zip",
+                            headers={"Content-Disposition": "attachment; filename=\"processed_images.zip\""})
+        boundary = uuid.uuid4().hex
+        return Response(content=build_multipart(entries, boundary),
+                        media_type=f"multipart/mixed; boundary={boundary}")
+
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"处理图像时发生未处理的错误: {e}")
+        logger.exception("批量处理图像时发生未处理的错误: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def estimate_job_cost(source: CachedSource) -> float:
+    """
+    只根据文件头估算处理开销（MB）：帧数 × 像素数 × 每像素通道数。自动缩小的静态图像按缩小后的尺寸计算。
+    """
+    width, height = source.target_size or source.dimensions
+    return width * height * source.frame_count * Image.getmodebands(source.mode) / (1024 * 1024)
+
+
+def job_progress_callback(job: Job):
+    """
+    工作线程中的进度回调，转到事件循环中更新任务进度。
+    进程池无法传递回调函数，此时只在任务完成时更新进度。
+    """
+    if processing_pool.pool_type != "thread":
+        return None
+    loop = asyncio.get_running_loop()
+    return lambda frames_done: loop.call_soon_threadsafe(job.set_progress, frames_done)
+
+
+async def run_when_available(func, *args):
+    # 任务已经在调度器中排过队，工作池被同步请求占满时等待，而不是返回 503
+    while processing_pool.is_full():
+        await asyncio.sleep(JOB_RETRY_SECONDS)
+    return await processing_pool.run(func, *args)
+
+
+def job_error(job: Job) -> tuple:
+    if isinstance(job.error, HTTPException):
+        return job.error.status_code, job.error.detail
+    return 500, str(job.error)
+
+
+def job_status(job: Job) -> dict:
+    status = job.snapshot()
+    status["queue_position"] = job_scheduler.queue_position(job)
+    if job.status == "failed":
+        status["error"] = job_error(job)[1]
+    return status
+
+
+async def find_job(job_id: str) -> tuple:
+    """
+    返回 (本进程的 Job, None)，或多个 worker 时由其他 worker 执行的任务 (None, (状态, 快照, 结果))
+    """
+    job = job_scheduler.get(job_id)
+    if job is not None:
+        return job, None
+    stored = await asyncio.to_thread(job_store.load, job_id) if job_store is not None else None
+    if stored is None:
+        raise HTTPException(status_code=404, detail="任务不存在或已过期")
+    return None, stored
+
+
+async def save_job_result(job_id: str, data: bytes, actual_format: str) -> Optional[str]:
+    # 多个 worker 时结果写入临时目录，其他 worker 也能读取；目录按 job_id 命名，和其他输出一样按时过期
+    if job_store is None:
+        return None
+    output_path = os.path.join(await file_manager.get_user_dir(job_id), f"result.{actual_format}")
+    await asyncio.to_thread(write_file, output_path, data)
+    await file_manager.track(job_id, len(data))
+    return output_path
+
+
+job_published: Dict[str, float] = {}
+
+
+def publish_job(job: Job):
+    """
+    把任务状态写入共享状态。执行中的进度最多每 JOB_PUBLISH_INTERVAL_SECONDS 写一次，状态变化总是写入。
+    """
+    now = time.time()
+    if (job.status == "running" and job.frames_done
+            and now - job_published.get(job.job_id, 0) < JOB_PUBLISH_INTERVAL_SECONDS):
+        return
+    result = None
+    if job.status == "done":
+        _, actual_format, cache_key, cache_status, output_path = job.result
+        result = {"path": output_path, "format": actual_format, "cache_key": cache_key, "cache_status": cache_status}
+        job_published.pop(job.job_id, None)
+    elif job.status == "failed":
+        status_code, detail = job_error(job)
+        result = {"status_code": status_code, "detail": detail}
+        job_published.pop(job.job_id, None)
+    else:
+        job_published[job.job_id] = now
+    # 快照在事件循环中取出，写入交给单独的线程按提交顺序执行，旧状态不会覆盖新状态
+    job_state_writer.submit(save_job_state, job.job_id, job.status, job_status(job), result, now)
+
+
+def save_job_state(job_id: str, status: str, snapshot: dict, result: Optional[dict], now: float):
+    try:
+        job_store.save(job_id, status, snapshot, result, now)
+    except Exception as e:
+        # 共享状态写入失败只影响其他 worker 上的查询，不影响任务本身
+        logger.warning("写入任务状态失败 %s: %s", job_id, e)
+
+
+@app.post("/jobs", status_code=202)
+async def submit_job(
+        request: Request,
+        file: Optional[UploadFile] = File(None),
+        source_id: Optional[str] = Form(None),
+        horizontal_crop_percent: int = Form(...),
+        vertical_crop_percent: int = Form(...),
+        selected_side: str = Form(...),
+        output_format: str = Form("auto"),
+        quality: Optional[int] = Form(None),
+        lossless: bool = Form(False),
+        webp_method: Optional[int] = Form(None)
+):
+    """
+    提交异步处理任务并立即返回，客户端不需要在处理期间保持连接。
+    之后通过 /jobs/{job_id} 查询状态，/jobs/{job_id}/events 订阅逐帧进度，/jobs/{job_id}/result 获取结果。
+    任务按文件头估算的开销排队，开销小的先执行，等待时间越长优先级越高。
+    """
+    validate_crop_params(selected_side, horizontal_crop_percent, vertical_crop_percent)
+    horizontal_crop_percent, vertical_crop_percent = normalize_crop_percent(
+        horizontal_crop_percent, vertical_crop_percent, selected_side)
+    client_id = client_key(request)
+    if job_scheduler.client_unfinished(client_id) >= MAX_JOBS_PER_CLIENT:
+        raise HTTPException(status_code=429, detail=f"每个客户端最多同时提交 {MAX_JOBS_PER_CLIENT} 个未完成的任务",
+                            headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+    if job_scheduler.draining:
+        raise HTTPException(status_code=503, detail="服务器正在关闭，请稍后再试",
+                            headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+    if job_scheduler.queued >= MAX_QUEUED_JOBS:
+        raise HTTPException(status_code=503, detail="任务队列已满，请稍后再试",
+                            headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+
+    try:
+        source = await request_source(file, source_id)
+        actual_format, save_options, variant = resolve_output(source, output_format, quality, lossless, webp_method)
+        cache_key = make_cache_key(source.digest, horizontal_crop_percent, vertical_crop_percent, selected_side,
+                                   variant)
+        job = Job(client_id, estimate_job_cost(source), source.frame_count)
+        if job_store is not None:
+            job.observer = publish_job
+
+        cached = await asyncio.to_thread(result_cache.get, cache_key)
+        if cached is not None:
+            output_path = await save_job_result(job.job_id, cached[0], cached[1])
+            job_scheduler.add_finished(job, (cached[0], cached[1], cache_key, "HIT", output_path))
+        else:
+            await asyncio.to_thread(rate_limiter.charge, client_id,
+                                    len(source.content) * source.frame_count // RATE_LIMIT_WORK_UNIT)
+            decoded = source.decoded if source.decoded is not None else source.content
+
+            async def work(job: Job):
+                data = await run_when_available(render_job, decoded, source.is_animated, horizontal_crop_percent,
+                                                vertical_crop_percent, selected_side, actual_format,
+                                                source.target_size, save_options, job_progress_callback(job))
+                await asyncio.to_thread(result_cache.put, cache_key, data, actual_format)
+                return data, actual_format, cache_key, "MISS", await save_job_result(job.job_id, data, actual_format)
+
+            job.work = work
+            job_scheduler.submit(job)
+        logger.debug("提交任务 %s，预估开销 %.1fMB", job.job_id, job.cost)
+        return JSONResponse(status_code=202, content=job_status(job), headers={"Location": f"/jobs/{job.job_id}"})
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("提交任务时发生未处理的错误: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    job, stored = await find_job(job_id)
+    return job_status(job) if job is not None else stored[1]
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """
+    以 Server-Sent Events 推送任务状态，事件名为任务状态，数据与 /jobs/{job_id} 相同。
+    执行中每处理完一帧推送一次，客户端读取较慢时只收到最新的状态；任务结束后关闭连接。
+    """
+    job, stored = await find_job(job_id)
+
+    async def events():
+        while True:
+            changed = job.changed
+            yield f"event: {job.status}\ndata: {json.dumps(job_status(job))}\n\n"
+            if job.status in ("done", "failed"):
+                return
+            await changed.wait()
+
+    async def stored_events():
+        # 其他 worker 的任务：轮询共享状态，有变化时推送
+        status, snapshot, _ = stored
+        last = None
+        while True:
+            if snapshot != last:
+                yield f"event: {status}\ndata: {json.dumps(snapshot)}\n\n"
+                last = snapshot
+            if status in ("done", "failed"):
+                return
+            await asyncio.sleep(JOB_POLL_SECONDS)
+            current = await asyncio.to_thread(job_store.load, job_id)
+            if current is None:
+                return
+            status, snapshot, _ = current
+
+    if job is None:
+        return StreamingResponse(stored_events(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    job, stored = await find_job(job_id)
+    if job is None:
+        return stored_job_result(job_id, *stored)
+    if job.status == "failed":
+        status_code, detail = job_error(job)
+        raise HTTPException(status_code=status_code, detail=detail)
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail="任务尚未完成",
+                            headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+    data, actual_format, cache_key, cache_status, _ = job.result
+    return Response(content=data, media_type=f"image/{actual_format}",
+                    headers=result_headers(job.job_id, cache_key, cache_status))
+
+
+def stored_job_result(job_id: str, status: str, snapshot: dict, result: Optional[dict]):
+    # 其他 worker 执行的任务，结果从共享的临时目录读取
+    if status == "failed":
+        raise HTTPException(status_code=result["status_code"], detail=result["detail"])
+    if status != "done":
+        raise HTTPException(status_code=409, detail="任务尚未完成",
+                            headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+    if not os.path.exists(result["path"]):
+        raise HTTPException(status_code=404, detail="任务结果已过期")
+    return FileResponse(result["path"], media_type=f"image/{result['format']}",
+                        headers=result_headers(job_id, result["cache_key"], result["cache_status"]))
+
+
+@app.get("/cache-stats")
+async def cache_stats():
+    rate_limit = await asyncio.to_thread(rate_limiter.stats)
+    return {"results": result_cache.stats(), "sources": source_cache.stats(), "rate_limit": rate_limit,
+            "jobs": job_scheduler.stats()}
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(content=metrics_registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.get("/")
 async def serve_index():
     file_path = os.path.join(HTML_DIR, INDEX_FILE)
@@ -214,5 +1458,6 @@ async def serve_index():
         raise HTTPException(status_code=404, detail="Index file not found.")
 
 if __name__ == "__main__":
+    # 开发模式：单进程，修改代码后自动重载。生产环境使用 python server.py，预先 fork 多个 worker
     import uvicorn
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
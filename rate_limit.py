@@ -0,0 +1,123 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Tuple
+
+from shared_state import SqliteConnection
+
+
+class MemoryRateLimitBackend:
+    """
+    单进程内的令牌桶存储。每个客户端只保存 (剩余令牌, 更新时间) 两个数，
+    客户端表按最近访问做 LRU，超过 max_clients 时淘汰最久未访问的客户端。
+    """
+    def __init__(self, max_clients: int):
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+        self.buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    def take(self, key: str, cost: float, capacity: float, refill_per_second: float,
+             allow_debt: bool = False) -> Tuple[bool, float]:
+        now = time.time()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (capacity, now))
+            allowed, tokens, retry_after = refill_and_take(tokens, updated, now, cost, capacity,
+                                                           refill_per_second, allow_debt)
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        return allowed, retry_after
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"backend": "memory", "clients": len(self.buckets)}
+
+
+class SqliteRateLimitBackend:
+    """
+    基于本地 SQLite 文件的令牌桶存储，同一台机器上的多个 uvicorn worker 共享同一份限流状态。
+    BEGIN IMMEDIATE 保证读改写是原子的；桶已回满的行等价于不存在，定期删除以限制表大小。
+    """
+    def __init__(self, path: str, max_clients: int):
+        self.max_clients = max_clients
+        self.connection = SqliteConnection(path)
+        with self.connection.transaction() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS buckets "
+                               "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS buckets_updated ON buckets (updated)")
+
+    def take(self, key: str, cost: float, capacity: float, refill_per_second: float,
+             allow_debt: bool = False) -> Tuple[bool, float]:
+        now = time.time()
+        with self.connection.transaction() as connection:
+            row = connection.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row is not None else (capacity, now)
+            allowed, tokens, retry_after = refill_and_take(tokens, updated, now, cost, capacity,
+                                                           refill_per_second, allow_debt)
+            connection.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                               (key, tokens, now))
+            if row is None:
+                self.prune(connection, now - capacity / refill_per_second)
+        return allowed, retry_after
+
+    def prune(self, connection: sqlite3.Connection, full_before: float):
+        # 只在出现新客户端时清理：先删掉已回满的桶，仍然超出上限时删除最久未访问的
+        connection.execute("DELETE FROM buckets WHERE updated < ?", (full_before,))
+        connection.execute("DELETE FROM buckets WHERE key IN (SELECT key FROM buckets ORDER BY updated DESC "
+                           "LIMIT -1 OFFSET ?)", (self.max_clients,))
+
+    def stats(self) -> dict:
+        clients = self.connection.get().execute("SELECT COUNT(*) FROM buckets").fetchone()[0]
+        return {"backend": "sqlite", "clients": clients}
+
+
+def refill_and_take(tokens: float, updated: float, now: float, cost: float, capacity: float,
+                    refill_per_second: float, allow_debt: bool) -> Tuple[bool, float, float]:
+    """
+    按经过的时间补充令牌后尝试扣除 cost。返回 (是否允许, 扣除后的令牌数, 需要等待的秒数)。
+    allow_debt 用于请求处理后才知道的工作量：总是扣除，令牌数可以变为负数，之后的请求需要等待还清。
+    """
+    tokens = min(capacity, tokens + (now - updated) * refill_per_second)
+    if tokens >= cost or allow_debt:
+        return True, tokens - cost, 0.0
+    return False, tokens, (cost - tokens) / refill_per_second
+
+
+class RateLimiter:
+    """
+    令牌桶限流：每个客户端的桶容量为 capacity，每 period_seconds 秒回满。
+    不同路由按 route_costs 扣除不同数量的令牌，处理开销大的请求还可以在知道工作量后追加扣除。
+    """
+    def __init__(self, backend, capacity: float, period_seconds: float, route_costs: dict):
+        self.backend = backend
+        self.capacity = capacity
+        self.refill_per_second = capacity / period_seconds
+        self.route_costs = route_costs
+
+    def route_cost(self, path: str) -> float:
+        # 除根路径外，以 / 结尾的键按前缀匹配，用于带路径参数的路由
+        cost = self.route_costs.get(path)
+        if cost is not None:
+            return cost
+        for route, cost in self.route_costs.items():
+            if route.endswith("/") and route != "/" and path.startswith(route):
+                return cost
+        return 1
+
+    def check(self, client_id: str, path: str) -> Tuple[bool, float]:
+        """
+        返回 (是否允许, 需要等待的秒数)
+        """
+        cost = self.route_cost(path)
+        if cost <= 0:
+            return True, 0.0
+        return self.backend.take(client_id, cost, self.capacity, self.refill_per_second)
+
+    def charge(self, client_id: str, cost: float):
+        # 追加扣除实际工作量，当前请求照常处理
+        if cost > 0:
+            self.backend.take(client_id, cost, self.capacity, self.refill_per_second, allow_debt=True)
+
+    def stats(self) -> dict:
+        return self.backend.stats()
@@ -0,0 +1,127 @@
+import argparse
+import logging
+import os
+import shutil
+import signal
+import socket
+import time
+
+import uvicorn
+
+logger = logging.getLogger(__name__)
+
+# 收到关闭信号后等待进行中的请求完成的最长时间，之后各 worker 再等待已接收的任务完成（main.JOB_DRAIN_SECONDS）
+GRACEFUL_SHUTDOWN_SECONDS = 30
+# worker 启动后很快退出时，等待一段时间再重启，避免反复崩溃占满 CPU
+RESTART_DELAY_SECONDS = 1
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="生产模式：预先加载应用，fork 多个 worker 共用同一个监听端口")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1,
+                        help="worker 进程数，默认为 CPU 核数")
+    parser.add_argument("--graceful-timeout", type=float, default=GRACEFUL_SHUTDOWN_SECONDS,
+                        help="关闭时等待进行中的请求完成的秒数")
+    return parser.parse_args(argv)
+
+
+def preload(workers: int):
+    """
+    在 fork 之前导入应用和全部 Pillow 插件，worker 通过写时复制共享这部分内存，不需要各自导入。
+    main 按 WEB_CONCURRENCY 决定是否通过 SQLite 共享限流、临时目录和任务状态，必须在导入之前设置。
+    """
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    from PIL import Image
+    Image.init()
+    import main
+    return main
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(app, sock: socket.socket, args):
+    # 独立的进程组：终端的 Ctrl+C 只发给主进程，由主进程转发一次 SIGTERM；
+    # uvicorn 收到第二次信号时会放弃等待直接退出
+    os.setpgid(0, 0)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    config = uvicorn.Config(app, host=args.host, port=args.port, timeout_graceful_shutdown=args.graceful_timeout)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def serve(argv=None):
+    """
+    主进程只负责监听端口、fork worker、转发关闭信号和重启意外退出的 worker。
+    收到 SIGTERM 或 SIGINT 后通知所有 worker 平滑关闭：停止接收连接，等待进行中的请求和任务完成；
+    再次收到信号时强制结束。所有 worker 退出后删除共用的临时目录。
+    """
+    args = parse_args(argv)
+    app_module = preload(args.workers)
+    sock = bind_socket(args.host, args.port)
+    workers = {}
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                run_worker(app_module.app, sock, args)
+            except BaseException:
+                logger.exception("worker 异常退出")
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        workers[pid] = time.monotonic()
+
+    def stop(signum, frame):
+        nonlocal stopping
+        kill_signal = signal.SIGKILL if stopping else signal.SIGTERM
+        if not stopping:
+            logger.info("正在关闭 %s 个 worker，等待进行中的请求和任务完成", len(workers))
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, kill_signal)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(args.workers):
+        spawn()
+    logger.info("已启动 %s 个 worker，监听 %s:%s", args.workers, args.host, args.port)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = workers.pop(pid, None)
+        if started is None or stopping:
+            continue
+        logger.warning("worker %s 意外退出（状态 %s），重新启动", pid, status)
+        if time.monotonic() - started < RESTART_DELAY_SECONDS:
+            time.sleep(RESTART_DELAY_SECONDS)
+        if not stopping:
+            spawn()
+
+    sock.close()
+    for directory in (app_module.TEMP_DIR, app_module.SOURCE_STORE_DIR):
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+    logger.info("所有 worker 已退出")
+
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,243 @@
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional
+
+
+class SqliteConnection:
+    """
+    按线程、按进程打开的 SQLite 连接。sqlite3 连接不能跨线程使用，
+    预先 fork 的 worker 也不能继续使用父进程打开的连接，进程号变化后重新连接。
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+
+    def get(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid():
+            # 父进程的连接只保留引用、不关闭，关闭也算在子进程中使用了它
+            self.local.inherited = connection
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE 在读之前就拿到写锁，多个进程的读改写不会交错
+        connection = self.get()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+
+class MemoryFileRegistry:
+    """
+    单进程内的临时目录索引。按最后访问时间排序的 OrderedDict 就是过期时间索引：
+    过期和超出配额的目录都在最前面，每次清理只弹出需要删除的条目，开销与过期数量成正比。
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # user_id -> (最后访问时间戳, 占用字节数)，最旧的排在最前面
+        self.user_dirs: "OrderedDict[str, tuple]" = OrderedDict()
+        self.total_bytes = 0
+
+    def reset(self, entries: list):
+        """
+        用磁盘上的实际目录重建索引，entries 为按时间排序的 (最后访问时间戳, user_id, 字节数)
+        """
+        with self.lock:
+            self.user_dirs.clear()
+            self.total_bytes = 0
+            for last_access, user_id, size in entries:
+                self.user_dirs[user_id] = (last_access, size)
+                self.total_bytes += size
+
+    def track(self, user_id: str, added_bytes: int, now: float):
+        with self.lock:
+            _, size = self.user_dirs.pop(user_id, (0, 0))
+            self.user_dirs[user_id] = (now, size + added_bytes)
+            self.total_bytes += added_bytes
+
+    def collect_expired(self, expire_before: float, quota_bytes: int, limit: int) -> list:
+        """
+        从索引中移除并返回最多 limit 个已过期或超出磁盘配额的 user_id
+        """
+        user_ids = []
+        with self.lock:
+            while self.user_dirs and len(user_ids) < limit:
+                user_id, (last_access, size) = next(iter(self.user_dirs.items()))
+                if last_access >= expire_before and self.total_bytes <= quota_bytes:
+                    break
+                del self.user_dirs[user_id]
+                self.total_bytes -= size
+                user_ids.append(user_id)
+        return user_ids
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"backend": "memory", "dirs": len(self.user_dirs), "bytes": self.total_bytes}
+
+
+class SqliteFileRegistry:
+    """
+    多个 worker 共享的临时目录索引，保存在本地 SQLite 文件中。
+    每个 worker 都能看到其他 worker 写入的目录，磁盘配额按所有 worker 的总量计算，过期目录只会被一个 worker 取走删除。
+    """
+    def __init__(self, path: str):
+        self.connection = SqliteConnection(path)
+        with self.connection.transaction() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS temp_dirs "
+                               "(user_id TEXT PRIMARY KEY, last_access REAL NOT NULL, bytes INTEGER NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS temp_dirs_last_access ON temp_dirs (last_access)")
+
+    def reset(self, entries: list):
+        with self.connection.transaction() as connection:
+            connection.execute("DELETE FROM temp_dirs")
+            connection.executemany("INSERT INTO temp_dirs (last_access, user_id, bytes) VALUES (?, ?, ?)", entries)
+
+    def track(self, user_id: str, added_bytes: int, now: float):
+        self.connection.get().execute(
+            "INSERT INTO temp_dirs (user_id, last_access, bytes) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET last_access = excluded.last_access, "
+            "bytes = bytes + excluded.bytes", (user_id, now, added_bytes))
+
+    def collect_expired(self, expire_before: float, quota_bytes: int, limit: int) -> list:
+        with self.connection.transaction() as connection:
+            total_bytes = connection.execute("SELECT COALESCE(SUM(bytes), 0) FROM temp_dirs").fetchone()[0]
+            rows = connection.execute("SELECT user_id, last_access, bytes FROM temp_dirs ORDER BY last_access LIMIT ?",
+                                      (limit,)).fetchall()
+            user_ids = []
+            for user_id, last_access, size in rows:
+                if last_access >= expire_before and total_bytes <= quota_bytes:
+                    break
+                total_bytes -= size
+                user_ids.append(user_id)
+            connection.executemany("DELETE FROM temp_dirs WHERE user_id = ?", [(user_id,) for user_id in user_ids])
+        return user_ids
+
+    def stats(self) -> dict:
+        dirs, total_bytes = self.connection.get().execute(
+            "SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM temp_dirs").fetchone()
+        return {"backend": "sqlite", "dirs": dirs, "bytes": total_bytes}
+
+
+class SqliteJobStore:
+    """
+    多个 worker 共享的异步任务状态。任务只在提交它的 worker 中执行，由该 worker 在状态变化时写入；
+    查询落到其他 worker 时从这里读取状态，结果从 result_path 指向的文件读取。
+    """
+    def __init__(self, path: str):
+        self.connection = SqliteConnection(path)
+        with self.connection.transaction() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, status TEXT NOT NULL, "
+                               "snapshot TEXT NOT NULL, result TEXT, updated REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (updated)")
+
+    def save(self, job_id: str, status: str, snapshot: dict, result: Optional[dict], now: float):
+        """
+        snapshot 是 /jobs/{job_id} 返回的状态；result 包含结果文件路径、格式和缓存键，或失败时的错误
+        """
+        self.connection.get().execute(
+            "INSERT OR REPLACE INTO jobs (job_id, status, snapshot, result, updated) VALUES (?, ?, ?, ?, ?)",
+            (job_id, status, json.dumps(snapshot), json.dumps(result) if result is not None else None, now))
+
+    def load(self, job_id: str) -> Optional[tuple]:
+        """
+        返回 (状态, 快照, 结果) 或 None
+        """
+        row = self.connection.get().execute("SELECT status, snapshot, result FROM jobs WHERE job_id = ?",
+                                            (job_id,)).fetchone()
+        if row is None:
+            return None
+        status, snapshot, result = row
+        return status, json.loads(snapshot), json.loads(result) if result is not None else None
+
+    def prune(self, updated_before: float):
+        self.connection.get().execute("DELETE FROM jobs WHERE updated < ?", (updated_before,))
+
+
+class SqliteSourceStore:
+    """
+    多个 worker 共享的上传源图像：原始字节按内容哈希保存在 directory 下，相同内容只存一份；
+    source_id 到哈希和文件头信息的索引保存在 SQLite 中。其他 worker 收到该 source_id 时从这里读取并重新解码。
+    """
+    def __init__(self, path: str, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.connection = SqliteConnection(path)
+        with self.connection.transaction() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS sources (source_id TEXT PRIMARY KEY, digest TEXT NOT NULL, "
+                               "meta TEXT NOT NULL, last_access REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS sources_last_access ON sources (last_access)")
+            connection.execute("CREATE INDEX IF NOT EXISTS sources_digest ON sources (digest)")
+
+    def content_path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest)
+
+    def save(self, source_id: str, digest: str, content: bytes, meta: dict, now: float):
+        """
+        meta 是重建 CachedSource 所需的文件头信息（格式、尺寸、帧数等）
+        """
+        path = self.content_path(digest)
+        # 写文件和插入索引在同一个写事务中，prune 不会在两者之间删掉这个文件
+        with self.connection.transaction() as connection:
+            if not os.path.exists(path):
+                # 先写临时文件再改名，其他 worker 不会读到写了一半的文件
+                temp_path = f"{path}.{os.getpid()}.tmp"
+                with open(temp_path, "wb") as f:
+                    f.write(content)
+                os.replace(temp_path, path)
+            connection.execute(
+                "INSERT OR REPLACE INTO sources (source_id, digest, meta, last_access) VALUES (?, ?, ?, ?)",
+                (source_id, digest, json.dumps(meta), now))
+
+    def touch(self, source_id: str, now: float):
+        self.connection.get().execute("UPDATE sources SET last_access = ? WHERE source_id = ?", (now, source_id))
+
+    def load(self, source_id: str, now: float) -> Optional[tuple]:
+        """
+        返回 (内容哈希, 原始字节, meta) 或 None，并刷新最后访问时间
+        """
+        connection = self.connection.get()
+        row = connection.execute("SELECT digest, meta FROM sources WHERE source_id = ?", (source_id,)).fetchone()
+        if row is None:
+            return None
+        digest, meta = row
+        try:
+            with open(self.content_path(digest), "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+        connection.execute("UPDATE sources SET last_access = ? WHERE source_id = ?", (now, source_id))
+        return digest, content, json.loads(meta)
+
+    def prune(self, expire_before: float):
+        """
+        删除过期的 source_id，以及不再被任何 source_id 引用的内容文件
+        """
+        with self.connection.transaction() as connection:
+            digests = [row[0] for row in connection.execute(
+                "SELECT DISTINCT digest FROM sources WHERE last_access < ?", (expire_before,)).fetchall()]
+            connection.execute("DELETE FROM sources WHERE last_access < ?", (expire_before,))
+            orphaned = [digest for digest in digests
+                        if connection.execute("SELECT 1 FROM sources WHERE digest = ? LIMIT 1",
+                                              (digest,)).fetchone() is None]
+            for digest in orphaned:
+                try:
+                    os.remove(self.content_path(digest))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self) -> dict:
+        entries = self.connection.get().execute("SELECT COUNT(*) FROM sources").fetchone()[0]
+        return {"backend": "sqlite", "entries": entries}